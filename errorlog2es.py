@@ -6,22 +6,29 @@
 #
 # Copyright 2016, YW. Jang, All rights reserved.
 
-import boto3
+import argparse
+import collections
+import copy
+import itertools
 import re
-import os
-import glob
 import time
+import traceback
 
-from datetime import date
 from datetime import datetime
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 from dateutil import tz, zoneinfo
 
 from elasticsearch import Elasticsearch
 
+from rdslogcommon import AdaptiveInterval, AwsClientPool, BulkIndexer, EC2NameCache, LogPortionDownloader
+from rdslogcommon import MarkerCheckpoint, PageSpool, PipelineStage, RawFileRemainer, TimestampConverter, splitLines
+
 class ErrorlogSender:
-  def __init__(self):
+  # In fleet mode, config overrides _GENERAL_CONFIG per instance and the others are shared.
+  def __init__(self, config=None, es=None, clients=None, checkpoint=None, reaminer=None, ec2names=None, indexer=None):
     self._ERRORLOG_PREFIX = "error/mysql-error-running.log."
+    self._WATERMARK = "watermark"
 
     self._GENERAL_CONFIG = {
       # Elasticsearch host name
@@ -42,103 +49,290 @@ class ErrorlogSender:
       # If you have ec2 instances, then It need region and VPC involving instances.
       "AWS_EC2_REGION_ID": "ap-northeast-2",
       "AWS_EC2_VPC_ID": "vpc-XXxxXXxx",
+      # The whole VPC is enumerated once in this hours, otherwise only new instances.
+      "EC2_CACHE_TTL_HOURS": 24,
+
+      # A bulk request is sent when either of size or count is exceeded.
+      "BULK_MAX_BYTES": 5 * 1024 * 1024,
+      "BULK_MAX_DOCS": 5000,
+      "BULK_CONCURRENCY": 2,
+
+      # Hourly files missed by late or failed runs are downloaded ahead by this number of threads.
+      # Each of them keeps up to CATCHUP_MEMORY_BYTES in memory, and the rest in a temporary file.
+      "CATCHUP_CONCURRENCY": 2,
+      "CATCHUP_MEMORY_BYTES": 8 * 1024 * 1024,
+
+      # Download runs in its own thread, with a bounded queue of pages.
+      "PIPELINE_QUEUE_SIZE": 8,
+
+      # Poll interval of daemon mode in seconds. It shortens while new data is arriving and lengthens while idle.
+      "DAEMON_MIN_INTERVAL": 5,
+      "DAEMON_MAX_INTERVAL": 300,
+
+      # Aborted connection and Access denied of the same user, host and db are sent as one document per window,
+      # if they occur more than AGGREGATE_MIN_COUNT times in it. 0 window sends every line.
+      "AGGREGATE_WINDOW_SEC": 60,
+      "AGGREGATE_MIN_COUNT": 5,
       }
+    if config:
+      self._GENERAL_CONFIG.update(config)
 
     self._REGEX4REFINE = {
       "QUERYTIME_REGEX": re.compile("^[a-zA-Z#:_ ]+([0-9.]+)[a-zA-Z:_ ]+([0-9.]+)[a-zA-Z:_ ]+([0-9.]+).[a-zA-Z:_ ]+([0-9.]+)$"),
       "GENERAL_ERR": re.compile("(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (\w+) \[(\w+)\] (.*)"),
       "ABORTED_CONN": re.compile("db: '(\w+)' user: '(\w+)' host: '([\w\d\.]+)'"),
-      "ACCESS_DENY": re.compile("user '(.*)'@'([\d\.]+)' "),
-      "DEADLOCK": re.compile("(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (\w+)"),
-      "ROLLBACK_TR": re.compile("\*\*\* WE ROLL BACK TRANSACTION \((\d+)\)"),
-      "HOLD_USER_INFO": re.compile("MySQL thread id (\w+), OS thread handle \w+, query id (\d+) ([\d\.]+) (\w+) "),
-      "HOLD_LOCK_INFO": re.compile("table `(\w+)`\.`(\w+)` trx id (\d+) lock_mode (\w+)")
+      "ACCESS_DENY": re.compile("user '(.*)'@'([\d\.]+)' ")
       }
       
     self._LOG_CONFIG = {
       "LOG_OUTPUT_DIR": "/var/log/rdslog/errorlog2es.log",
-      "RAW_OUTPUT_DIR": "/var/log/rdslog/errorlog" # (Optional)
+      "RAW_OUTPUT_DIR": "/var/log/rdslog/errorlog", # (Optional)
+
+      # Last read marker of each log file, so that only new tail is downloaded.
+      "CHECKPOINT_PATH": "/var/log/rdslog/errorlog2es.checkpoint",
+
+      # IP to Name map of ec2 instances per region and VPC.
+      "EC2_CACHE_DIR": "/var/log/rdslog/ec2cache"
       }
 
     self._ABORTED_CONN_MSG = "Aborted connection"
     self._ACCESS_DENY_MSG = "Access denied"
 
+    self._AGGREGATED_DETAILS = (self._ABORTED_CONN_MSG, self._ACCESS_DENY_MSG)
+
     self._BEGIN_DEADLOCK = "deadlock detected"
-    self._END_DEADLOCK = "WE ROLL BACK TRANSACTION"
-    self._BEGIN_TRX = "TRANSACTION"
-    self._TRASACTION_LENGTH = 9
 
-    self._es = Elasticsearch(self._GENERAL_CONFIG["ES_HOST"])
-    self._ec2dict = dict()
-    self._data = list()
+    self._es = es or Elasticsearch(self._GENERAL_CONFIG["ES_HOST"])
+    self._clients = clients or AwsClientPool()
+    self._ec2names = ec2names
+    self._unresolved = list()
+    self._indexer = indexer or BulkIndexer(
+      self._es,
+      max_bytes=self._GENERAL_CONFIG["BULK_MAX_BYTES"],
+      max_docs=self._GENERAL_CONFIG["BULK_MAX_DOCS"],
+      concurrency=self._GENERAL_CONFIG["BULK_CONCURRENCY"])
     self._num_of_total_doc = 0
-    self._reaminer = RawFileRemainer(self._LOG_CONFIG["RAW_OUTPUT_DIR"])
+    self._events = None
+    if self._GENERAL_CONFIG["AGGREGATE_WINDOW_SEC"] > 0:
+      self._events = ErrorEventAggregator(self._GENERAL_CONFIG["AGGREGATE_WINDOW_SEC"], self._GENERAL_CONFIG["AGGREGATE_MIN_COUNT"])
+    self._timestamps = TimestampConverter(self._GENERAL_CONFIG["TIMEZONE"])
+    self._reaminer = reaminer or RawFileRemainer(self._LOG_CONFIG["RAW_OUTPUT_DIR"])
+    self._checkpoint = checkpoint or MarkerCheckpoint(self._LOG_CONFIG["CHECKPOINT_PATH"])
+    self._marker = "0"
+    self._head_digest = ("", 0)
+    self._started = False
+
+    # Windows of aggregated events are held across polls of daemon mode until the file or its hour is closed.
+    self._daemon = False
+    self._held_file = None
+    self._held_hour = None
+    self._HOUR_GRACE = timedelta(minutes=10)
+    # The newest file keeps one archive segment across polls, so that it is one gzip member and one manifest entry.
+    # Pages of a poll are spooled, and appended to it only after the poll has sent them.
+    self._raw_file = None
+    self._raw_key = None
+    self._raw_pages = None
+    self._saved_aggregates = None
 
     self._now = datetime.now()
 
-  def validateLogDate(self, lines):
-    delta = timedelta(hours=2)
-  
-    for line in lines:
-      if not line:
-        continue
-      elif line.startswith("# Time: "):
-        log_time = datetime.strptime(line[8:], "%y%m%d %H:%M:%S")
-        log_time = log_time.replace(tzinfo=tz.tzutc()).astimezone(zoneinfo.gettz(self._GENERAL_CONFIG["TIMEZONE"]))
-        log_time = log_time.replace(tzinfo=None)
-        print(self._now, log_time)
-        print("diff :", self._now - log_time)
-        if (self._now - log_time) > delta:
-          return False
-        else:
-          return True
-      
-    return True
-    
   def initElasticsearchIndex(self):
     self._ES_INDEX = self._GENERAL_CONFIG["INDEX_PREFIX"] + "-" + datetime.strftime(self._now, "%Y.%m")
 
-  def initEC2InstancesInVpc(self, region, vpc):
-    ec2 = boto3.resource("ec2", region_name=region)
-    vpc = ec2.Vpc(vpc)
-    for i in vpc.instances.all():
-      for tag in i.tags:
-        if tag['Key'] == 'Name':
-          self._ec2dict[i.private_ip_address] = "".join(tag['Value'].split())
-
-  def getRdsLog(self, log_filename):
-    client = boto3.client("rds", region_name=self._GENERAL_CONFIG["AWS_RDS_REGION_ID"])
-    db_files = client.describe_db_log_files(DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"])
-
-    if not filter(lambda log: log["LogFileName"] == log_filename, db_files["DescribeDBLogFiles"]):
-      return ""
-
-    marker = "0"
-    log_data = ""
-
-    # It used like do-while statement.
-    ret = client.download_db_log_file_portion(
-        DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"],
-        LogFileName=log_filename,
-        Marker=marker,
-        NumberOfLines=500)
-    log_data = ret["LogFileData"]
-    marker = ret["Marker"]
-
-    while ret["AdditionalDataPending"]:
-      ret = client.download_db_log_file_portion(
-        DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"],
-        LogFileName=log_filename,
-        Marker=marker,
-        NumberOfLines=500)
-
-      log_data += ret["LogFileData"]
-      marker = ret["Marker"]
-      
+  def initEC2Names(self):
+    if not self._GENERAL_CONFIG["AWS_EC2_VPC_ID"]:
+      return
+
+    path = "%s/%s_%s.json" % (
+      self._LOG_CONFIG["EC2_CACHE_DIR"],
+      self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
+      self._GENERAL_CONFIG["AWS_EC2_VPC_ID"])
+    self._ec2names = EC2NameCache(
+      path,
+      self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
+      self._GENERAL_CONFIG["AWS_EC2_VPC_ID"],
+      self._clients,
+      ttl=timedelta(hours=self._GENERAL_CONFIG["EC2_CACHE_TTL_HOURS"]))
+    self._ec2names.refresh()
+
+  def lookupEC2Name(self, ip_addr):
+    if self._ec2names is None:
+      return "Missed"
+    return self._ec2names.lookup(ip_addr)
+
+  # Hold documents whose client is unknown, and resolve them at once.
+  def holdDoc(self, doc):
+    self._unresolved.append(doc)
+    if len(self._unresolved) >= 1000:
+      self.releaseDocs()
+
+  def releaseDocs(self):
+    if not self._unresolved:
+      return
+
+    self._ec2names.resolvePending()
+    unresolved = self._unresolved
+    self._unresolved = list()
+    for doc in unresolved:
+      doc["name"] = self._ec2names.getName(doc["host"])
+      self.appendDoc2Data(doc)
+
+  # Windows still open are closed when the file is closed, so a storm over two cron runs is sent as two documents.
+  def releaseEvents(self):
+    if self._events is None:
+      return
+
+    for doc in self._events.popEvents():
+      self.appendDoc2Data(doc)
+    print("Aggregated %(events)d events into %(docs)d docs" % self._events.getStats())
+
+  def getRdsClient(self):
+    return self._clients.getClient("rds", self._GENERAL_CONFIG["AWS_RDS_REGION_ID"])
+
+  # Hourly files written since the watermark, in order of time. Unchanged ones are skipped by resumeMarker.
+  def listRdsLogs(self):
+    client = self.getRdsClient()
+    watermark = self.loadWatermark()
+    db_files = client.describe_db_log_files(
+      DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"],
+      FilenameContains="mysql-error-running",
+      FileLastWritten=watermark)
+
+    # Only hourly files are read. The live file has the same data, and its marker is lost when it is rotated.
+    hourly_re = re.compile(re.escape(self._ERRORLOG_PREFIX) + "\\d+$")
+    log_files = [log for log in db_files["DescribeDBLogFiles"]
+                 if hourly_re.match(log["LogFileName"]) and log["LastWritten"] >= watermark]
+    return sorted(log_files, key=lambda log: log["LastWritten"])
+
+  # LastWritten of the newest file which has been sent completely. (milliseconds since epoch)
+  def loadWatermark(self):
+    cp = self._checkpoint.get(self._GENERAL_CONFIG["RDS_ID"], self._WATERMARK)
+    if cp:
+      return cp["last_written"]
+    # At the first run, only files of recent hours are read as before.
+    return int((time.time() - 2 * 3600) * 1000)
+
+  def saveWatermark(self, log_file):
+    self._checkpoint.update(self._GENERAL_CONFIG["RDS_ID"], self._WATERMARK, last_written=log_file["LastWritten"])
+    self._checkpoint.save()
+
+  def getRdsLogHead(self, log_filename, num_lines):
+    downloader = LogPortionDownloader(self.getRdsClient(), self._GENERAL_CONFIG["RDS_ID"], log_filename)
+    ret = downloader.downloadPortion("0", num_lines)
+    return ret.get("LogFileData") or ""
+
+  # Decide where to start downloading. It returns None as marker if nothing has been appended,
+  # and the checkpoint only when it is resumed from the middle.
+  def resumeMarker(self, log_file):
+    cp = self._checkpoint.get(self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"])
+    if not cp:
+      return "0", None
+
+    if log_file["Size"] == cp["size"] and log_file["LastWritten"] == cp["last_written"]:
+      return None, None
+    if log_file["Size"] < cp["size"] or not cp.get("head_lines"):
+      return "0", None
+
+    # The same file name is reused a day later, so compare the head of it unless it is written within an hour.
+    if log_file["LastWritten"] - cp["last_written"] < 3600 * 1000:
+      return cp["marker"], cp
+    head = self.getRdsLogHead(log_file["LogFileName"], cp["head_lines"])
+    if self._checkpoint.makeHeadDigest(head, cp["head_lines"]) != (cp["digest"], cp["head_lines"]):
+      return "0", None
+    return cp["marker"], cp
+
+  # It does not touch the state of a run, because older files are downloaded ahead in other threads.
+  def getRdsLog(self, downloader, marker="0", held=False):
+    # Delete old log files.
     self._reaminer.clearOutOfDateRawFiles()
-    self._reaminer.makeRawLog("mysql-error.log." + str(datetime.now().utcnow().hour), log_data)
+    if held:
+      raw_file = self.openHeldRawLog(downloader.getLogFileName())
+      if self._raw_pages is None:
+        self._raw_pages = PageSpool(self._GENERAL_CONFIG["CATCHUP_MEMORY_BYTES"])
+      raw_file = self._raw_pages
+    else:
+      raw_file = self._reaminer.openRawLog(self._GENERAL_CONFIG["RDS_ID"], downloader.getLogFileName())
+
+    try:
+      for page in downloader.download(marker):
+        raw_file.write(page)
+        yield page
+    finally:
+      if not held:
+        raw_file.close()
+
+  # It is called while the newest file is streamed, so the segment of the file held before is closed here.
+  def openHeldRawLog(self, log_filename):
+    key = (log_filename, self._reaminer.makeLogHour(log_filename))
+    if self._raw_file is not None and self._raw_key != key:
+      self.closeRawLog()
+    if self._raw_file is None:
+      self._raw_file = self._reaminer.openRawLog(self._GENERAL_CONFIG["RDS_ID"], log_filename)
+      self._raw_key = key
+    return self._raw_file
+
+  def commitRawLog(self):
+    if self._raw_pages is None:
+      return
+
+    for page in self._raw_pages.read():
+      self._raw_file.write(page)
+    self._raw_pages = None
+
+  def closeRawLog(self):
+    self.dropRawLog()
+    if self._raw_file is None:
+      return
+
+    self._raw_file.close()
+    self._raw_file = None
+    self._raw_key = None
+
+  def makeDownloader(self, log_file):
+    return LogPortionDownloader(self.getRdsClient(), self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"])
+
+  def fetchRdsLog(self, log_file, marker):
+    downloader = self.makeDownloader(log_file)
+    spool = PageSpool(self._GENERAL_CONFIG["CATCHUP_MEMORY_BYTES"])
+    try:
+      for page in self.getRdsLog(downloader, marker):
+        spool.write(page)
+    except Exception:
+      spool.close()
+      raise
+    return downloader, spool
+
+  # Yield (log_file, marker, cp, downloader, pages) in order of time. Files except the newest one are
+  # downloaded ahead by CATCHUP_CONCURRENCY threads, and the newest one is streamed.
+  def prefetchRdsLogs(self, plans):
+    older = plans[:-1]
+    pending = collections.deque()
+    pool = None
+    if older:
+      pool = ThreadPool(processes=self._GENERAL_CONFIG["CATCHUP_CONCURRENCY"])
+    try:
+      i = 0
+      while i < len(older) or pending:
+        while i < len(older) and len(pending) < self._GENERAL_CONFIG["CATCHUP_CONCURRENCY"]:
+          log_file, marker, cp = older[i]
+          pending.append((older[i], pool.apply_async(self.fetchRdsLog, (log_file, marker))))
+          i += 1
 
-    return log_data
+        (log_file, marker, cp), result = pending.popleft()
+        downloader, spool = result.get()
+        yield log_file, marker, cp, downloader, spool.read()
+    finally:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      # Spools downloaded ahead but not read, e.g. after a failure.
+      for plan, result in pending:
+        if result.ready() and result.successful():
+          result.get()[1].close()
+
+    log_file, marker, cp = plans[-1]
+    downloader = self.makeDownloader(log_file)
+    yield log_file, marker, cp, downloader, self.getRdsLog(downloader, marker, held=True)
 
   def getRdsLog4Debug(self, path):
     content = ""
@@ -183,57 +377,236 @@ class ErrorlogSender:
     else:
       print("Create template failed.")
 
-  def appendDoc2Data(self, doc, flush=False):
-    self._data.append({"index": {
-                         "_index": self._ES_INDEX,
-                         "_type": self._GENERAL_CONFIG["RDS_ID"] }})
-    self._data.append(doc)
+  def appendDoc2Data(self, doc):
+    if "name" in doc and doc["name"] is None:
+      self.holdDoc(doc)
+      return
+
+    self._indexer.append({"index": {
+                            "_index": self._ES_INDEX,
+                            "_type": self._GENERAL_CONFIG["RDS_ID"] }}, doc)
 
     self._num_of_total_doc += 1
 
-    
-    if len(self._data) > 10000 or flush:
-      self._es.bulk(index=self._ES_INDEX, body=self._data, refresh=flush)
-      print("%s : Write doc into data that length is %s" % (str(datetime.now()), len(self._data)))
+  # A refresh makes documents searchable at once. Polls of daemon mode leave it to the refresh interval of the index,
+  # except when aggregates are closed.
+  def flushData(self, refresh=True):
+    self._indexer.close(refresh=refresh)
+
+    sent, failed = self._indexer.getStats()
+    print("%s : Sent %d docs, failed %d docs" % (str(datetime.now()), sent, failed))
+    print("send : %(requests)d requests, %(docs_per_sec).1f docs/s, busy %(busy).1fs, blocked %(blocked).1fs, in flight %(inflight)d/%(concurrency)d" %
+          self._indexer.getCounters())
+
+  def saveCheckpoint(self, log_file):
+    self._checkpoint.update(
+      self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"],
+      marker=self._marker,
+      size=log_file["Size"],
+      last_written=log_file["LastWritten"],
+      digest=self._head_digest[0],
+      head_lines=self._head_digest[1])
+    self._checkpoint.save()
+
+  # Only once a process, and not on every poll of daemon mode.
+  def start(self):
+    if self._started:
+      return
+
+    self.createTemplate(self._GENERAL_CONFIG["INDEX_PREFIX"])
+    self._started = True
+
+  # The same file name is reused for the next hour a day later, so the hour is compared as well.
+  def holdFile(self, log_filename):
+    hour = self._reaminer.makeLogHour(log_filename)
+    if self._held_file is not None and (self._held_file != log_filename or self._held_hour != hour):
+      self.closeAggregates()
+    self._held_file = log_filename
+    self._held_hour = hour
+
+  # RDS may still append to the file of an hour for a while after the hour, as the cron job in README waits for.
+  def isHeldFileClosed(self):
+    if self._held_file is None:
+      return False
+    return datetime.utcnow() >= self._held_hour + timedelta(hours=1) + self._HOUR_GRACE
+
+  # A poll which fails in the middle of a file is retried from the last marker. So the aggregates are restored to
+  # the last file sent, and the pages of the poll are dropped, not to be counted twice.
+  def saveAggregates(self):
+    self._saved_aggregates = copy.deepcopy(self._events)
+
+  def rollbackAggregates(self):
+    self._unresolved = list()
+    self.dropRawLog()
+    if self._saved_aggregates is None:
+      return
+
+    print("%s : Roll back aggregates of %s" % (str(datetime.now()), self._held_file))
+    self._events = self._saved_aggregates
+    self._saved_aggregates = None
+
+  def dropRawLog(self):
+    if self._raw_pages is None:
+      return
+
+    self._raw_pages.close()
+    self._raw_pages = None
+
+  def closeAggregates(self):
+    if self._held_file is None:
+      return
+
+    print("%s : Close aggregates of %s" % (str(datetime.now()), self._held_file))
+    self.releaseEvents()
+    self.releaseDocs()
+    self._indexer.flush(refresh=True)
+    self._held_file = None
+    self._held_hour = None
 
   def run(self):
     self.initElasticsearchIndex()
-    log_filename = self._ERRORLOG_PREFIX + str((self._now).utcnow().hour)
-    log_data = self.getRdsLog(log_filename)
-
-    if not log_data:
-      print("%s does not exist!" % (log_filename))
+    log_files = self.listRdsLogs()
+    if not log_files:
+      print("%s* have no file written since the last run!" % (self._ERRORLOG_PREFIX))
       return -1
 
-    lines = log_data.split("\n")
-    if len(lines) > 0:
-      if not self.validateLogDate(lines):
-        print("%s already read log!" % (log_filename))
-        return -2
-    else:
+    plans = list()
+    for log_file in log_files:
+      marker, cp = self.resumeMarker(log_file)
+      if marker is None:
+        print("%s already read log!" % (log_file["LogFileName"]))
+        continue
+      plans.append((log_file, marker, cp))
+    if not plans:
+      return -2
+
+    # It is shared already in fleet mode.
+    if self._ec2names is None:
+      self.initEC2Names()
+    self.start()
+
+    if len(plans) > 1:
+      print("%s : Catch up %d files from %s" % (str(datetime.now()), len(plans), plans[0][0]["LogFileName"]))
+    try:
+      for log_file, marker, cp, downloader, pages in self.prefetchRdsLogs(plans):
+        self.collectErrorLog(log_file, marker, cp, downloader, pages)
+    except Exception:
+      self.rollbackAggregates()
+      raise
+    if not self._daemon:
+      self.closeAggregates()
+      self.closeRawLog()
+    self.flushData(refresh=not self._daemon)
+
+    print("Written Errorlogs : %s" % str(self._num_of_total_doc))
+
+  # One cycle of daemon mode, with clients, caches and connections kept warm. It returns True if anything was sent.
+  def poll(self):
+    self._daemon = True
+    self._now = datetime.now()
+    if self._ec2names is not None:
+      self._ec2names.refresh()
+    active = self.run() is None
+    if self.isHeldFileClosed():
+      self.closeAggregates()
+      self.closeRawLog()
+      self.flushData()
+    return active
+
+  # Windows held by polls are sent before the daemon exits.
+  def stop(self):
+    self.closeAggregates()
+    self.closeRawLog()
+    self.flushData()
+
+  def runForever(self):
+    interval = AdaptiveInterval(self._GENERAL_CONFIG["DAEMON_MIN_INTERVAL"], self._GENERAL_CONFIG["DAEMON_MAX_INTERVAL"])
+    try:
+      while True:
+        try:
+          active = self.poll()
+        except Exception:
+          # It keeps running, and waits longer while it fails.
+          traceback.print_exc()
+          active = False
+        time.sleep(interval.next(active))
+    finally:
+      self.stop()
+
+  # Send a file, and move its checkpoint and the watermark only after documents have been sent.
+  def collectErrorLog(self, log_file, marker, cp, downloader, pages):
+    log_filename = log_file["LogFileName"]
+    first_page = next(pages, "")
+    if not first_page:
       print("%s is empty!" % (log_filename))
-      return -3
+      return
 
-    sself.initEC2InstancesInVpc(
-      self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
-      self._GENERAL_CONFIG["AWS_EC2_VPC_ID"])
-    self.createTemplate(self._GENERAL_CONFIG["INDEX_PREFIX"])
+    self._head_digest = ("", 0)
+    if cp is not None:
+      self._head_digest = (cp["digest"], cp["head_lines"])
+    if marker == "0":
+      self._head_digest = self._checkpoint.makeHeadDigest(first_page)
 
     print("%s : Ready to write %s in %s" % (str(datetime.now()), log_filename, self._ES_INDEX))
-    i = 0
-    doc = {}
+    self.holdFile(log_filename)
+    if self._daemon:
+      self.saveAggregates()
+    # Pages are downloaded in its own thread, while this thread parses lines and feeds the indexer.
+    stage = PipelineStage("download", itertools.chain([first_page], pages), self._GENERAL_CONFIG["PIPELINE_QUEUE_SIZE"])
+    try:
+      self.parseErrorLog(splitLines(stage))
+    finally:
+      stage.close()
+      if hasattr(pages, "close"):
+        pages.close()
+    self.releaseDocs()
+    self._indexer.flush()
+
+    print(downloader.getStats())
+    print(stage.getStats())
+
+    self.commitRawLog()
+    self._saved_aggregates = None
+    self._marker = downloader.marker
+    self.saveCheckpoint(log_file)
+    self.saveWatermark(log_file)
+
+  # Parse archived raw log again, e.g. when the index is rebuilt. hour is UTC hour of the log file.
+  # Pages are the members of one file in the order they were archived.
+  def replay(self, pages, hour):
+    self._now = self._timestamps.makeLocalTime(hour.year, hour.month, hour.day, hour.hour, 0, 0).replace(tzinfo=None)
+    self.initElasticsearchIndex()
+    if self._ec2names is None:
+      self.initEC2Names()
+
+    self.parseErrorLog(splitLines(pages))
+    self.releaseEvents()
+    self.releaseDocs()
+    return self._num_of_total_doc
+
+  def initTemplate(self):
+    self.createTemplate(self._GENERAL_CONFIG["INDEX_PREFIX"])
+
+  # Every line is visited once, so lines can be any iterable. A deadlock dump is fed to DeadlockParser until it ends.
+  def parseErrorLog(self, lines):
+    deadlock = None
 
-    while i < len(lines):
-      line = lines[i]
+    for i, line in enumerate(lines):
       if not line:
-        i += 1
         continue
 
-      if doc:
-        self.appendDoc2Data(doc)
+      m = self._REGEX4REFINE["GENERAL_ERR"].match(line)
+      if deadlock is not None:
+        # A dump which is cut by the next entry is sent as it is.
+        if m is None and self._BEGIN_DEADLOCK not in line and deadlock.feed(line):
+          if deadlock.isClosed():
+            self.appendDoc2Data(deadlock.getDoc())
+            deadlock = None
+          continue
+        self.appendDoc2Data(deadlock.getDoc())
+        deadlock = None
 
       doc = {}
-      m = self._REGEX4REFINE["GENERAL_ERR"].match(line)
       if m:
         doc["type"] = "Errorlog"
         doc["code"] = m.group(2)
@@ -248,11 +621,7 @@ class ErrorlogSender:
           doc["db"] = match.group(1)
           doc["user"] = match.group(2)
           doc["host"] = match.group(3)
-          ip_addr = match.group(3)
-          if ip_addr not in self._ec2dict:
-            doc["name"] = "Missed"
-          else:
-            doc["name"] = self._ec2dict[ip_addr]
+          doc["name"] = self.lookupEC2Name(match.group(3))
         elif self._ACCESS_DENY_MSG in message:
           doc["detail"] = self._ACCESS_DENY_MSG
           match = self._REGEX4REFINE["ACCESS_DENY"].search(message)
@@ -262,168 +631,229 @@ class ErrorlogSender:
           doc["detail"] = "Other"
         doc["message"] = message
 
-        timestamp = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
-        timestamp = timestamp.replace(tzinfo=tz.tzutc()).astimezone(zoneinfo.gettz(self._GENERAL_CONFIG["TIMEZONE"]))
-        doc["timestamp"] = timestamp.isoformat()
-
-      elif self._BEGIN_DEADLOCK in line:
-        doc["type"] = "Deadlock"
-        i += 1 # ignore deadlock dectected message
-        m = self._REGEX4REFINE["DEADLOCK"].match(lines[i])
-
-        timestamp = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
-        timestamp = timestamp.replace(tzinfo=tz.tzutc()).astimezone(zoneinfo.gettz(self._GENERAL_CONFIG["TIMEZONE"]))
-        doc["timestamp"] = timestamp.isoformat()
-        doc["code"] = m.group(2)
-        i += 1 # get next line
-
-        # This transaction wait for using the lock.
-        tr_a = ""
-        for offset in range(self._TRASACTION_LENGTH):
-          tr_a += lines[i + offset] + "\n"
-        i += self._TRASACTION_LENGTH
-        doc["transaction_a"] = tr_a
-
-        # Skip non-readable messages.
-        while self._BEGIN_TRX not in lines[i]:
-          i += 1
-
-        # This transaction hold the lock.
-        tr_b = ""
-        for offset in range(self._TRASACTION_LENGTH):
-          tr_b += lines[i + offset] + "\n"
-
-        doc["transaction_b"] = tr_b
+        doc["timestamp"] = self._timestamps.convertErrorLogTime(m.group(1))
+        doc["count"] = 1
 
-        m = self._REGEX4REFINE["HOLD_USER_INFO"].search(tr_b)
-        doc["hold_lock_thread_id"] = m.group(1)
-        doc["hold_lock_query_id"] = m.group(2)
-        doc["hold_lock_usr"] = m.group(3)
-        doc["hold_lock_ip"] = m.group(4)
+        if self._events is not None and doc["detail"] in self._AGGREGATED_DETAILS:
+          for closed in self._events.add(doc, m.group(1)):
+            self.appendDoc2Data(closed)
+          continue
 
-        m = self._REGEX4REFINE["HOLD_LOCK_INFO"].search(tr_b)
-        doc["hold_lock_db"] = m.group(1)
-        doc["hold_lock_tb"] = m.group(2)
-        doc["hold_lock_trx_id"] = m.group(3)
-        doc["hold_lock_trx_mode"] = m.group(4)
-
-        while self._END_DEADLOCK not in lines[i]:
-          i += 1
-        m = self._REGEX4REFINE["ROLLBACK_TR"].match(lines[i])
-        rollback = ""
-        if m.group(1) == "1": rollback = "a"
-        else: rollback = "b"
-        doc["rollback"] = rollback
+      elif self._BEGIN_DEADLOCK in line:
+        deadlock = DeadlockParser(self._timestamps)
+        deadlock.feed(line)
+        continue
       else:
         print("Parse Error at", i)
         doc["type"] = "Other"
         doc["message"] = line
+        doc["count"] = 1
+
+      self.appendDoc2Data(doc)
+
+    if deadlock is not None:
+      self.appendDoc2Data(deadlock.getDoc())
+
+
+# Parse a deadlock dump of InnoDB in a single pass. Lines are fed one by one, and any number of transactions,
+# held and waited locks are kept. A dump which is cut before "WE ROLL BACK TRANSACTION" is closed as it is.
+class DeadlockParser:
+  def __init__(self, timestamps):
+    self._REGEX4DEADLOCK = {
+      "HEADER": re.compile("^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (\w+)"),
+      "TRANSACTION": re.compile("^\*\*\* \((\d+)\) TRANSACTION:"),
+      "TRX_INFO": re.compile("^TRANSACTION (\w+), ACTIVE (\d+) sec"),
+      "THREAD": re.compile("^MySQL thread id (\w+), OS thread handle \w+, query id (\d+) (\S+) (\S+)"),
+      "SECTION": re.compile("^\*\*\* \((\d+)\) (HOLDS THE LOCK|WAITING FOR THIS LOCK)"),
+      "LOCK": re.compile("^(RECORD|TABLE) LOCKS? .*?(?:index `?([^` ]+)`? of )?table `([^`]+)`\.`([^`]+)`.* trx id (\w+) lock[_ ]mode (\w+)(.*)$"),
+      "ROLLBACK": re.compile("^\*\*\* WE ROLL BACK TRANSACTION \((\d+)\)"),
+    }
+    self._timestamps = timestamps
 
-      i += 1
-
-    if doc:
-      print("%s : Write last data that length is %s (%s)" % (str(datetime.now()), len(self._data), len(doc)))
-      self.appendDoc2Data(doc, flush=True)
-
-    print("Written Errorlogs : %s" % str(self._num_of_total_doc))
+    self._doc = {"type": "Deadlock", "transactions": list()}
+    self._trx = None
+    self._state = "begin"
+    self._closed = False
 
+  def isClosed(self):
+    return self._closed
 
-class DirectoryManager:
-  def __init__(self, path="/var/log"):
-    self._raw_path = path
+  # It returns False if the line does not belong to the dump, e.g. the dump was cut.
+  def feed(self, line):
+    if self._state == "begin":
+      self._state = "header"
+      m = self._REGEX4DEADLOCK["HEADER"].match(line)
+      if m:
+        self.setHeader(m)
+      return True
 
-  def readInputPath(self, input_path):
-    input_files = list()
+    if line.startswith("*** "):
+      return self.feedSection(line)
 
-    if os.path.isfile(input_path):
-      input_files.append(input_path)
-    else:
-      for (dirpath, dirnames, filelist) in os.walk(input_path):
-        for fname in filelist:
-          input_files.extend(dirpath + "/" + fname)
-    return input_files
+    if self._state == "header":
+      m = self._REGEX4DEADLOCK["HEADER"].match(line)
+      if m:
+        self.setHeader(m)
+        return True
+      return False
 
-  def readDatePath(self, date_path):
-    date_file_list = glob.glob(date_path + "/[0-9]*/[0-9]*/[0-9]*")
-    date_path_list = filter(lambda d: os.path.isdir(d), date_file_list)
+    self._trx["text"].append(line)
+    if self._state == "info":
+      m = self._REGEX4DEADLOCK["TRX_INFO"].match(line)
+      if m:
+        self._trx["trx_id"] = m.group(1)
+        self._trx["active_sec"] = int(m.group(2))
+        return True
+      m = self._REGEX4DEADLOCK["THREAD"].match(line)
+      if m:
+        self._trx["thread_id"] = m.group(1)
+        self._trx["query_id"] = m.group(2)
+        self._trx["host"] = m.group(3)
+        self._trx["user"] = m.group(4)
+        self._state = "query"
+    elif self._state == "query":
+      self._trx["query"] = (self._trx["query"] + "\n" + line) if self._trx["query"] else line
+    elif self._state in ("holds", "waits"):
+      m = self._REGEX4DEADLOCK["LOCK"].match(line)
+      if m:
+        self._trx[self._state].append({
+          "lock_type": m.group(1),
+          "index": m.group(2),
+          "db": m.group(3),
+          "table": m.group(4),
+          "trx_id": m.group(5),
+          "lock_mode": m.group(6),
+          "detail": m.group(7).strip(),
+        })
+      else:
+        # Physical records are too verbose to be kept.
+        self._trx["text"].pop()
+    return True
 
-    return map(self.regularizePath, date_path_list)
+  def setHeader(self, m):
+    self._doc["timestamp"] = self._timestamps.convertErrorLogTime(m.group(1))
+    self._doc["code"] = m.group(2)
 
-  def regularizePath(self, s):
-    return re.sub("[\\\|/]+", "/", s)
+  def feedSection(self, line):
+    m = self._REGEX4DEADLOCK["TRANSACTION"].match(line)
+    if m:
+      self._trx = {"number": int(m.group(1)), "query": "", "holds": list(), "waits": list(), "text": [line]}
+      self._doc["transactions"].append(self._trx)
+      self._state = "info"
+      return True
 
-  def mkdir(self, path):
-    if not os.path.exists(path):
-      os.makedirs(path)
+    m = self._REGEX4DEADLOCK["ROLLBACK"].match(line)
+    if m:
+      self._doc["rollback_transaction"] = int(m.group(1))
+      self._closed = True
+      return True
 
-  def rmdir(self, path):
-    # It prevents from deleting all your disk files.
-    if path == "/" or not os.path.exists(path):
+    if self._trx is None:
       return False
-
-    for root, dirs, files in os.walk(path, topdown=False):
-      for name in files:
-        print('remove: ' + os.path.join(root, name))
-        os.remove(os.path.join(root, name))
-      for name in dirs:
-        print('removedir: ' + os.path.join(root, name))
-        os.removedirs(os.path.join(root, name))
+    m = self._REGEX4DEADLOCK["SECTION"].match(line)
+    self._state = "waits" if m and m.group(2).startswith("WAITING") else "holds"
+    self._trx["text"].append(line)
     return True
 
-  def isEmptyDir(self, dir):
-    if os.path.exists(dir) and os.listdir(dir) == []:
-      return True
-    else:
-      return False
-
+  # Fields of the first two transactions are kept as before, since they are used by dashboards.
+  def getDoc(self):
+    doc = self._doc
+    doc["count"] = 1
+    trxs = doc["transactions"]
+    texts = ["\n".join(trx.pop("text")) + "\n" for trx in trxs]
+    if len(trxs) > 0:
+      doc["transaction_a"] = texts[0]
+    if len(trxs) > 1:
+      doc["transaction_b"] = texts[1]
+      hold = trxs[1]
+      doc["hold_lock_thread_id"] = hold.get("thread_id")
+      doc["hold_lock_query_id"] = hold.get("query_id")
+      doc["hold_lock_usr"] = hold.get("user")
+      doc["hold_lock_ip"] = hold.get("host")
+
+      locks = hold["holds"] or hold["waits"]
+      if locks:
+        doc["hold_lock_db"] = locks[0]["db"]
+        doc["hold_lock_tb"] = locks[0]["table"]
+        doc["hold_lock_trx_id"] = locks[0]["trx_id"]
+        doc["hold_lock_trx_mode"] = locks[0]["lock_mode"]
+
+    if "rollback_transaction" in doc:
+      doc["rollback"] = "a" if doc["rollback_transaction"] == 1 else "b"
+    return doc
+
+
+# Count repetitive events per detail, user, host, db and time window. Rare ones are sent in detail as they are,
+# and the others as one document with count, first and last seen times and a sample message.
+class ErrorEventAggregator:
+  def __init__(self, window_sec, min_count):
+    self._window_sec = window_sec
+    self._min_count = min_count
+    self._events = collections.OrderedDict()
+    self._window = None
+
+    self._num_of_events = 0
+    self._num_of_docs = 0
+
+  # "2016-12-11 10:00:01" of error log. Windows are aligned in UTC day.
+  def makeWindow(self, s):
+    seconds = int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+    return (s[0:10], seconds // self._window_sec)
+
+  # Lines are in time order, so windows before the new one are closed and returned.
+  def add(self, doc, s):
+    window = self.makeWindow(s)
+    closed = list()
+    if self._window is None or window > self._window:
+      if self._window is not None:
+        closed = list(self.popEvents(window))
+      self._window = window
+
+    key = (doc["detail"], doc.get("user"), doc.get("host"), doc.get("db"), window)
+    event = self._events.get(key)
+    if event is None:
+      event = {"docs": list(), "count": 0}
+      self._events[key] = event
+
+    event["count"] += 1
+    event["last_seen"] = doc["timestamp"]
+    if len(event["docs"]) < self._min_count:
+      event["docs"].append(doc)
+    self._num_of_events += 1
+    return closed
+
+  def popEvents(self, before=None):
+    keys = [key for key in self._events if before is None or key[4] < before]
+    for key in keys:
+      event = self._events.pop(key)
+      if event["count"] <= self._min_count:
+        docs = event["docs"]
+      else:
+        docs = [self.makeDoc(event)]
 
-class RawFileRemainer(DirectoryManager):
-  def __init__(self, path):
-    DirectoryManager.__init__(self, path)
-    self._due_date = timedelta(weeks=2)
+      self._num_of_docs += len(docs)
+      for doc in docs:
+        yield doc
 
-  def clearOutOfDateRawFiles(self):
-    target = self.readDatePath(self._raw_path)
+  def makeDoc(self, event):
+    doc = dict(event["docs"][0])
+    doc["count"] = event["count"]
+    doc["first_seen"] = doc["timestamp"]
+    doc["last_seen"] = event["last_seen"]
+    doc["aggregated"] = True
+    return doc
 
-    for t in target:
-      sp = t.split("/")
-      if self.isOutOfDate(int(sp[-3]), int(sp[-2]), int(sp[-1])):
-        print("delete : " + t)
-        self.rmdirRecursively(t)
+  def getStats(self):
+    return {"events": self._num_of_events, "docs": self._num_of_docs}
 
-  def isOutOfDate(self, year, month, day):
-    target = date(year, month, day)
-    if (date.today() - target) > self._due_date:
-      return True
-    else:
-      return False
 
-  def rmdirRecursively(self, target_dir):
-    self.rmdir(target_dir)
-
-    if self.isEmptyDir(target_dir):
-      print("removedirs!: " + target_dir)
-      os.removedirs(target_dir)
-    month_dir = target_dir[:-3]
-    if self.isEmptyDir(month_dir):
-      print("isEmptyDir!: " + month_dir)
-      os.removedirs(month_dir)
-    year_dir = target_dir[:-6]
-    if self.isEmptyDir(year_dir):
-      print("isEmptyDir!: " + year_dir)
-      os.removedirs(year_dir)
-
-  def makeRawLog(self, name, raw_data):
-    cur_date_path = self._raw_path + datetime.now().strftime("/%Y/%m/%d/")
-    raw_name = datetime.now().strftime("%Hh%Mm%Ss_") + name
-
-    if not os.path.exists(cur_date_path):
-      self.mkdir(cur_date_path)
-    f = open(cur_date_path + raw_name, "w")
-    f.write(raw_data)
-    f.close()
-    
-    
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-d", "--daemon", dest="daemon", help="keep polling instead of a run", action="store_true")
+  args = parser.parse_args()
+
   el2es = ErrorlogSender()
-  el2es.run()
\ No newline at end of file
+  if args.daemon:
+    el2es.runForever()
+  else:
+    el2es.run()
\ No newline at end of file
@@ -8,8 +8,11 @@
 
 import boto3
 import yaml
-#import mysql.connector
+import mysql.connector
+import mysql.connector.pooling
 import subprocess
+import signal
+import threading
 
 import logging
 import logging.handlers
@@ -20,8 +23,18 @@ import timeit
 
 import sys
 import collections
+import pickle
+import zlib
 import os # mkdir
-import codecs # file R/W
+import gzip
+import io
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from multiprocessing.pool import ThreadPool
 
 class QueueKey:
   def __init__(self):
@@ -32,7 +45,7 @@ class QueueKey:
 
 # DAOs...
 class ShellCommander(QueueKey):
-  def __init__(self, host, port, region, user, password):
+  def __init__(self, host, port, region, user, password, timeout=10):
     QueueKey.__init__(self)
     self._rds_id = ""
 
@@ -41,6 +54,7 @@ class ShellCommander(QueueKey):
     self._region = region
     self._user = user
     self._passwrod = password
+    self._timeout = timeout
 
   def getRdsStatus(self):
     return dict({
@@ -52,23 +66,55 @@ class ShellCommander(QueueKey):
 
   def getInnodbStatus(self):
     query = "mysql -h %s -u %s -P %s -p%s -e 'SHOW ENGINE INNODB STATUS\\G'" % (self._host, self._user, self._port, self._passwrod)
-    result = subprocess.check_output(query, stderr=subprocess.STDOUT, shell=True)
-    return result
+    return self.execute(query)
 
   def getProcessList(self):
     query = "mysql -h %s -u %s -P %s -p%s -e 'SHOW FULL PROCESSLIST'|grep -v 'Sleep'" % (self._host, self._user, self._port, self._passwrod)
-    result =  subprocess.check_output(query, stderr=subprocess.STDOUT, shell=True)
+    return self.execute(query)
+
+  # The whole process group is killed after timeout, so that a hung instance never holds a worker.
+  # The command is not in the error, because it has the password.
+  def execute(self, query):
+    proc = subprocess.Popen(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **self.makeSessionArgs(query))
+    timer = threading.Timer(self._timeout, self.kill, (proc,))
+    timer.start()
+    try:
+      result = proc.communicate()[0]
+    finally:
+      timer.cancel()
+
+    if proc.returncode != 0:
+      raise RuntimeError("mysql to %s exited with %d" % (self._host, proc.returncode))
     return result
 
+  # The process leads a new session, so that its group is killed at once. preexec_fn is not safe with threads,
+  # so python2.7 in threads makes the session by setsid(1) instead.
+  def makeSessionArgs(self, query):
+    if sys.version_info[0] >= 3:
+      return {"args": query, "shell": True, "start_new_session": True}
+    if threading.active_count() == 1:
+      return {"args": query, "shell": True, "preexec_fn": os.setsid}
+    return {"args": ["setsid", "sh", "-c", query]}
+
+  def kill(self, proc):
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+# Connections are kept in a pool between ticks, so that neither fork/exec nor handshake is paid for every sample.
+# The pure python connector applies connection_timeout to every read, which bounds each query as well.
 class MySqlConnector(QueueKey):
-  def __init__(self, host, port, region, user, password):
+  def __init__(self, host, port, region, user, password, timeout=10, pool_size=2):
     QueueKey.__init__(self)
     self._db_config = {
       "user": user,
       "password": password,
       "host": host,
       "port": port,
-      "raise_on_warnings": True,
+      "connection_timeout": timeout,
+      "use_pure": True,
+      "autocommit": True,
       }
 
     self._rds_id = ""
@@ -77,30 +123,43 @@ class MySqlConnector(QueueKey):
     self._region = region
     self._user = user
     self._password = password
+    self._pool_size = pool_size
 
-    # It need on python2.7, but does not on python3.4
-    self._conn = mysql.connector.connect(**self._db_config)
-    self._cursor = self._conn.cursor()
+    # It is made at the first query, so that an instance down at start does not stop the monitor.
+    self._pool = None
+    self._pool_lock = threading.Lock()
 
     self._INNODB_STATUS_QUERY = "SHOW ENGINE INNODB STATUS"
     self._PROCESS_LIST_QUERY = "SHOW FULL PROCESSLIST"
+    self._HEARTBEAT_QUERY = "SELECT 1"
+
+  def getPool(self):
+    with self._pool_lock:
+      if self._pool is None:
+        self._pool = mysql.connector.pooling.MySQLConnectionPool(
+          pool_name=("rdschker_" + self._rds_id)[:64], pool_size=self._pool_size, **self._db_config)
+      return self._pool
+
+  # Rows are dicts of typed values. A connection closed by wait_timeout or failover is reconnected and tried once more.
+  def execute(self, query):
+    conn = self.getPool().get_connection()
+    try:
+      for retry in (True, False):
+        try:
+          cursor = conn.cursor(dictionary=True)
+          cursor.execute(query)
+          rows = cursor.fetchall()
+          cursor.close()
+          return rows
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+          if not retry:
+            raise
+          conn.reconnect(attempts=1)
+    finally:
+      conn.close() # back to the pool
 
   def sendHeartBit(self):
-    self._cursor.execute("SELECT 1")
-    # just flush
-    self._cursor.fetchall()
-
-  def connect(self, logger):
-    try:
-      self._conn = mysql.connector.connect(**self._db_config)
-      self._cursor = self._conn.cursor()
-    except mysql.connector.Error as err:
-      if err.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
-        logger.info("Something is wrong with your user name or password")
-      elif err.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-        logger.info("Database does not exist")
-      else:
-        logger.info(err)
+    self.execute(self._HEARTBEAT_QUERY)
 
   def getRdsStatus(self):
     return dict({
@@ -111,46 +170,14 @@ class MySqlConnector(QueueKey):
       })
 
   def getInnodbStatus(self):
-    self._cursor.execute(self._INNODB_STATUS_QUERY)
-    result = self._cursor.fetchall()
-
-    innodb_status = ""
-    if len(result) == 0:
-      return innodb_status
-    for i in result[0]:
-      # In Python 2.7
-      #innodb_status += unicode(i).encode("utf-8", "replace")
-      innodb_status += i
-      # In Python 3.4
-      #innodb_status += str(i)
-
-    return innodb_status
+    rows = self.execute(self._INNODB_STATUS_QUERY)
+    if len(rows) == 0:
+      return ""
+    return rows[0]["Status"]
 
+  # Sleeping connections are left out as ShellCommander does.
   def getProcessList(self):
-    self._cursor.execute(self._PROCESS_LIST_QUERY)
-    result = self._cursor.fetchall()
-
-    result_str = ""
-    for d in self._cursor.description:
-      # In Python 2.7
-      result_str += d[0] + "\t"
-      #result_str += unicode(d[0]).encode("utf-8", "replace") + "\t"
-      # In Python 3.4
-      #result_str += str(d[0]) + "\t"
-    result_str += "\n"
-
-    for row in result:
-      for i in row:
-        # In Python 2.7
-        result_str += i + "\t"
-        # In Python 3.4
-        #result_str += str(i) + "\t"
-      result_str += "\n"
-
-    return result_str
-
-  def disconnect(self):
-    self._conn.close()
+    return [row for row in self.execute(self._PROCESS_LIST_QUERY) if row["Command"] != "Sleep"]
 
 class RdsMonitor(QueueKey):
   def __init__(self):
@@ -174,11 +201,22 @@ class RdsMonitor(QueueKey):
     self._interval = 30
     self._duration = 600
     self._out_path = ""
-
-    self._LOG_EXT = ".log"
+    self._capture_timeout = 10
+    self._capture_workers = 32
+    self._history = 600
+    self._memory_mb = 64
+    self._write_queue_size = 64
 
     # status queue
-    self._rds_status_q = list()
+    self._rds_status_q = StatusRingBuffer(self._history // self._interval + 1, self._memory_mb * 1024 * 1024)
+
+    # Status of each instance is captured in its own worker. A capture still running is kept until it ends.
+    self._pool = None
+    self._captures = dict()
+
+    # Files are written by its own thread, so that disk latency does not delay sampling.
+    self._writer = None
+    self._written = 0
 
     # logger
     self._rdslogger = RdsMonLogger()
@@ -190,9 +228,15 @@ class RdsMonitor(QueueKey):
   def loadRdsMonConfig(self, input):
     config = self.readYaml(input)
 
+    self._capture_timeout = config["condition"].get("timeout", self._capture_timeout)
+    self._capture_workers = config["condition"].get("workers", self._capture_workers)
+
     # read keys in monitor-config.yml
     for i in config["dao"]:
-      dao = ShellCommander(i["host"], i["port"], i["region"], i["user"], i["password"])
+      if i.get("type", "mysql") == "shell":
+        dao = ShellCommander(i["host"], i["port"], i["region"], i["user"], i["password"], self._capture_timeout)
+      else:
+        dao = MySqlConnector(i["host"], i["port"], i["region"], i["user"], i["password"], self._capture_timeout, i.get("pool_size", 2))
       dao._rds_id = (i["host"])[:i["host"].index(".")]
       self._dao.append(dao)
 
@@ -200,9 +244,15 @@ class RdsMonitor(QueueKey):
     self._interval = config["condition"]["interval"]
     self._duration = config["condition"]["duration"]
 
+    # History before a problem is kept up to history(sec) within memory_mb.
+    self._history = config["condition"].get("history", self._duration)
+    self._memory_mb = config["condition"].get("memory_mb", self._memory_mb)
+    self._rds_status_q = StatusRingBuffer(int(self._history / self._interval) + 1, int(self._memory_mb * 1024 * 1024))
+
     self._out_path = config["output"]["path"]
     if self._out_path[-1] != "/":
       self._out_path += "/";
+    self._write_queue_size = config["output"].get("queue_size", self._write_queue_size)
 
     #for i in self._dao:
       #i.connect(self._rdslogger._logger)
@@ -220,10 +270,43 @@ class RdsMonitor(QueueKey):
     for dao in self._dao:
       dao.sendHeartBit()
 
+  def captureRdsStatus(self, dao):
+    try:
+      return dao.getRdsStatus()
+    except Exception as e:
+      self._rdslogger._logger.warn("Capture failed : %s, %s", dao._rds_id, e)
+      return self.makeFailedStatus(dao, str(e))
+
+  def makeFailedStatus(self, dao, reason):
+    message = "Failed to capture : %s\n" % reason
+    return dict({
+      self._RDS_ID: dao._rds_id,
+      self._INNODB_STATUS: message,
+      self._PROCESS_LIST: message,
+      self._TIME_STAMP: datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+      })
+
+  # Every instance is captured at the same time, so a tick takes as long as the slowest one up to the timeout.
   def enequeueRdsStatus(self):
+    if self._pool is None:
+      self._pool = ThreadPool(max(1, min(self._capture_workers, len(self._dao))))
+
+    for i in self._dao:
+      if i._rds_id not in self._captures:
+        self._captures[i._rds_id] = self._pool.apply_async(self.captureRdsStatus, (i,))
+
+    deadline = timeit.default_timer() + self._capture_timeout
     results = list()
     for i in self._dao:
-      results.append(i.getRdsStatus())
+      capture = self._captures[i._rds_id]
+      capture.wait(max(0, deadline - timeit.default_timer()))
+      if not capture.ready():
+        self._rdslogger._logger.warn("Capture timeout : %s", i._rds_id)
+        results.append(self.makeFailedStatus(i, "timeout"))
+        continue
+
+      del self._captures[i._rds_id]
+      results.append(capture.get())
 
     self._rds_status_q.append(results)
 
@@ -252,43 +335,46 @@ class RdsMonitor(QueueKey):
           return False
     return True
 
+  # Snapshots written already, e.g. during the previous problem, are not written again.
   def writeAllInQueue(self):
-    for i in self._rds_status_q:
-      self.writeFile(i)
+    self.writeFiles(list(self._rds_status_q.since(self._written)))
+    self._written = self._rds_status_q.getSequence()
 
   def writeLatestInQueue(self):
-    self.writeFile(self._rds_status_q[len(self._rds_status_q) - 1])
-
-  def writeFile(self, status):
-    for s in status:
-      cur_date = self._out_path + (s[self._TIME_STAMP])[0:8]
-      if not os.path.exists(cur_date):
-        os.makedirs(cur_date)
-
-      output_prefix = (s[self._TIME_STAMP])[8:] + "_" + s[self._RDS_ID]
-      innodb_stat_path = cur_date + "/" + output_prefix + "_" + self._INNODB_STATUS + self._LOG_EXT
-      ps_path = cur_date + "/" + output_prefix + "_" + self._PROCESS_LIST + self._LOG_EXT
-
-      self.writeStatus(innodb_stat_path, s[self._INNODB_STATUS])
-      self.writeStatus(ps_path, s[self._PROCESS_LIST])
-
-  def writeStatus(self, file_name, content):
-    out_file = codecs.open(file_name, "wb")
-    out_file.write(content)
-    out_file.close()
-    self._rdslogger._logger.info("Write : %s", file_name)
-
-  def run(self):
+    if self._written < self._rds_status_q.getSequence():
+      self.writeFiles([self._rds_status_q.latest()])
+    self._written = self._rds_status_q.getSequence()
+
+  # Snapshots of some ticks are handed over at once. They are dropped if the writer is too far behind.
+  def writeFiles(self, statuses):
+    if self._writer is None:
+      self._writer = IncidentWriter(self._out_path, self._rdslogger._logger, self._write_queue_size)
+    self._writer.put(statuses)
+
+  # One watcher per region fetches every metric of its instances in a few calls.
+  def makeWatchers(self):
+    watchers = collections.OrderedDict()
     for i in self._dao:
+      if i._region not in watchers:
+        watchers[i._region] = CloudWatcher(i._region)
       for m in self._target_metrics.keys():
-        w = CloudWatcher(i._region, i._rds_id, m)
-        w.loadRegion(i._region)
-        self._watchers.append(w)
+        watchers[i._region].addMetric(i._rds_id, m)
+    self._watchers = list(watchers.values())
+
+  def run(self):
+    self.makeWatchers()
 
     self._rdslogger._logger.info("==================================")
     self._rdslogger._logger.info("===  RDS Monitor get started!  ===")
     self._rdslogger._logger.info("==================================")
 
+    try:
+      self.monitor()
+    finally:
+      if self._writer is not None:
+        self._writer.close()
+
+  def monitor(self):
     expiry_date = datetime.datetime.min
     while True:
       start = timeit.default_timer()
@@ -319,9 +405,7 @@ class RdsMonitor(QueueKey):
         else:
           self._rdslogger._logger.info("Rds is currently stable.")
 
-      # dequeue
-      if len(self._rds_status_q) > (self._duration / self._interval):
-        self._rds_status_q.pop(0)
+      self._rdslogger._logger.info("Queue : %d snapshots in %d bytes", len(self._rds_status_q), self._rds_status_q.getBytes())
 
       # Test output files.
       #self.writeLatestInQueue()
@@ -334,6 +418,170 @@ class RdsMonitor(QueueKey):
       # You have to consider wait_timeout prameter in RDS, because it have to smaller than sleep time.
       #self.testHealthCheck()
 
+# Snapshots of every tick are kept compressed, and decompressed only when they are written.
+# The oldest ones are dropped when either of capacity or max_bytes is exceeded.
+class StatusRingBuffer:
+  def __init__(self, capacity, max_bytes):
+    self._capacity = max(1, capacity)
+    self._max_bytes = max_bytes
+    self._snapshots = collections.deque()
+    self._bytes = 0
+
+    # Sequence of the latest one. The oldest one kept is sequence - len + 1.
+    self._sequence = 0
+
+    # The latest one is also kept as it is, because it is written on every tick during a problem.
+    self._latest = None
+
+  def append(self, status):
+    snapshot = zlib.compress(pickle.dumps(status, pickle.HIGHEST_PROTOCOL))
+    self._snapshots.append(snapshot)
+    self._bytes += len(snapshot)
+    self._latest = status
+    self._sequence += 1
+
+    # The latest one is always kept, even if it exceeds max_bytes alone.
+    while len(self._snapshots) > 1 and (len(self._snapshots) > self._capacity or self._bytes > self._max_bytes):
+      self._bytes -= len(self._snapshots.popleft())
+
+  def latest(self):
+    return self._latest
+
+  def __iter__(self):
+    return self.since(0)
+
+  # Snapshots appended after the sequence, from the oldest one.
+  def since(self, sequence):
+    first = self._sequence - len(self._snapshots) + 1
+    for i, snapshot in enumerate(list(self._snapshots)):
+      if first + i > sequence:
+        yield pickle.loads(zlib.decompress(snapshot))
+
+  def getSequence(self):
+    return self._sequence
+
+  def __len__(self):
+    return len(self._snapshots)
+
+  def getBytes(self):
+    return self._bytes
+
+# Snapshots are appended to one gzip file per instance per day as gzip members, which zcat reads at once.
+# "<timestamp>\t<offset>\t<length>" of each member is appended to its index, so that a snapshot is read alone.
+class IncidentWriter(QueueKey):
+  def __init__(self, out_path, logger, max_size=64):
+    QueueKey.__init__(self)
+    self._DATA_EXT = ".log.gz"
+    self._INDEX_EXT = ".idx"
+
+    self._out_path = out_path
+    self._logger = logger
+    self._queue = queue.Queue(max_size)
+
+    self._thread = threading.Thread(target=self.run, name="IncidentWriter")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def put(self, statuses):
+    try:
+      self._queue.put_nowait(statuses)
+    except queue.Full:
+      self._logger.warn("Writer is behind, dropped %d snapshots", len(statuses))
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+
+  # Everything queued so far is written as a batch, which opens each file once.
+  def run(self):
+    while True:
+      batch = [self._queue.get()]
+      while True:
+        try:
+          batch.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+
+      statuses = list()
+      for item in batch:
+        if item is not None:
+          statuses.extend(item)
+      try:
+        self.write(statuses)
+      except Exception as e:
+        self._logger.warn("Write failed : %s", e)
+
+      if None in batch:
+        return
+
+  def write(self, statuses):
+    snapshots = collections.OrderedDict()
+    for status in statuses:
+      for s in status:
+        key = ((s[self._TIME_STAMP])[0:8], s[self._RDS_ID])
+        snapshots.setdefault(key, list()).append(s)
+
+    for (day, ins), ss in snapshots.items():
+      cur_date = self._out_path + day
+      if not os.path.exists(cur_date):
+        os.makedirs(cur_date)
+
+      path = cur_date + "/" + ins
+      self.appendSnapshots(path, ss)
+      self._logger.info("Write : %d snapshots in %s", len(ss), path + self._DATA_EXT)
+
+  def appendSnapshots(self, path, snapshots):
+    data_path = path + self._DATA_EXT
+    offset = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+
+    index = list()
+    with open(data_path, "ab") as f:
+      for s in snapshots:
+        member = self.compress(self.formatSnapshot(s))
+        f.write(member)
+        index.append("%s\t%d\t%d\n" % (s[self._TIME_STAMP], offset, len(member)))
+        offset += len(member)
+
+    # The index is written after data, so that every entry in it points to complete data.
+    with open(path + self._INDEX_EXT, "a") as f:
+      f.write("".join(index))
+
+  def compress(self, data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+      f.write(data)
+    return buf.getvalue()
+
+  def formatSnapshot(self, s):
+    parts = list()
+    for key in (self._INNODB_STATUS, self._PROCESS_LIST):
+      content = s[key]
+      if isinstance(content, list):
+        content = self.formatRows(content)
+      if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+      header = "=== %s %s %s ===\n" % (s[self._TIME_STAMP], s[self._RDS_ID], key)
+      parts.append(header.encode("utf-8") + content + b"\n")
+    return b"".join(parts)
+
+  # Rows of MySqlConnector are written in tab separated text, as the mysql client does.
+  def formatRows(self, rows):
+    if len(rows) == 0:
+      return ""
+
+    columns = list(rows[0].keys())
+    lines = ["\t".join(columns)]
+    for row in rows:
+      lines.append("\t".join(self.formatValue(row[c]) for c in columns))
+    return "\n".join(lines) + "\n"
+
+  def formatValue(self, value):
+    if value is None:
+      return "NULL"
+    if isinstance(value, (bytes, bytearray)):
+      return value.decode("utf-8", "replace")
+    return u"%s" % value
+
 class RdsMonLogger:
   def __init__(self):
     self._logger = logging.getLogger('RDS_MON_LOGGER')
@@ -361,45 +609,75 @@ class RdsMonLogger:
       h.setFormatter(formatter)
       self._logger.addHandler(h)
 
+# Maximum of each metric in the last minutes, fetched by batched GetMetricData queries of a region.
 class CloudWatcher():
-  def __init__(self, region, ins_name, metric):
-    self._clients = dict()
-    self._status = collections.defaultdict(lambda : collections.defaultdict(dict))
+  # Limit of metric data queries in a single request.
+  MAX_QUERIES = 500
 
+  def __init__(self, region):
     self._client = boto3.client("cloudwatch", region_name = region)
     self._region = region
-    self._ins_name = ins_name
-    self._metric = metric
+    self._queries = list()
+
+  def addMetric(self, ins_name, metric):
+    self._queries.append((ins_name, metric))
+
+  # Id of a query must begin with a lowercase letter.
+  def makeQuery(self, i, ins_name, metric):
+    return {
+      "Id": "m%d" % i,
+      "MetricStat": {
+        "Metric": {
+          "Namespace": "AWS/RDS",
+          "MetricName": metric,
+          "Dimensions": [
+                          {
+                            "Name": "DBInstanceIdentifier",
+                            "Value": ins_name,
+                          },
+                        ],
+          },
+        "Period": 60,
+        "Stat": "Maximum",
+        },
+      "ReturnData": True,
+      }
 
-  def loadRegion(self, r):
-    self._clients[r] = boto3.client("cloudwatch", region_name = r)
+  def getMetricData(self, queries, start, end):
+    results = list()
+    kwargs = dict(MetricDataQueries = queries, StartTime = start, EndTime = end, ScanBy = "TimestampDescending")
+    while True:
+      response = self._client.get_metric_data(**kwargs)
+      results.extend(response["MetricDataResults"])
+      if not response.get("NextToken"):
+        return results
+      kwargs["NextToken"] = response["NextToken"]
 
   def watch(self, status, logger):
-    response = self._client.get_metric_statistics(
-      Namespace = "AWS/RDS",
-      MetricName = self._metric,
-      Dimensions = [
-                     {
-                       "Name": "DBInstanceIdentifier",
-                       "Value": self._ins_name,
-                     },
-                   ],
-      StartTime = datetime.datetime.utcnow() - datetime.timedelta(minutes=2),
-      EndTime = datetime.datetime.utcnow(),
-      Period = 60,
-      Statistics = ["Maximum"]
-      )
-
-    if len(response["Datapoints"]) > 0:
-      status[self._ins_name][self._metric] = response["Datapoints"][0]["Maximum"]
-      if self._metric.endswith("Latency"):
-          status[self._ins_name][self._metric] *= float(1000)
-      cur_stat = self._ins_name + "[" + self._metric + "]=" + str(status[self._ins_name][self._metric])
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(minutes=2)
+
+    values = dict()
+    for offset in range(0, len(self._queries), self.MAX_QUERIES):
+      queries = [self.makeQuery(offset + i, ins_name, metric)
+                 for i, (ins_name, metric) in enumerate(self._queries[offset:offset + self.MAX_QUERIES])]
+      for result in self.getMetricData(queries, start, end):
+        # Values are sorted from the latest one.
+        if result["Values"]:
+          values.setdefault(result["Id"], result["Values"][0])
+
+    for i, (ins_name, metric) in enumerate(self._queries):
+      value = values.get("m%d" % i)
+      if value is None:
+        status[ins_name][metric] = -1
+        continue
+
+      status[ins_name][metric] = value
+      if metric.endswith("Latency"):
+          status[ins_name][metric] *= float(1000)
+      cur_stat = ins_name + "[" + metric + "]=" + str(status[ins_name][metric])
       logger.info(cur_stat)
       print(cur_stat)
-      #logger.info("%s[%s]=%0.5f", self._ins_name, self._metric, status[self._ins_name][self._metric])
-    else:
-      status[self._ins_name][self._metric] = -1
 
 if __name__ == "__main__":
   mon = RdsMonitor()
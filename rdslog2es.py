@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+# Project   : Transfer slowquery and error logs of many RDS instances to elastic search.
+# Author    : YW. Jang
+# Date      : 2016.12.20
+#
+# Copyright 2016, YW. Jang, All rights reserved.
+
+import argparse
+import collections
+import multiprocessing
+import sys
+import time
+import traceback
+
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+from elasticsearch import Elasticsearch
+
+import errorlog2es
+import rdslogcommon
+import slowquery2es
+
+
+# Each worker process of replay sends its own documents through one client and indexer, and keeps one parser per
+# kind of log and instance. A parser has no checkpoint, since replay never resumes a file.
+_REPLAY_WORKER = dict()
+
+
+def initReplayWorker(es_host, bulk):
+    es = Elasticsearch(es_host, maxsize=bulk.get("BULK_CONCURRENCY", 2))
+    _REPLAY_WORKER["es"] = es
+    _REPLAY_WORKER["clients"] = rdslogcommon.AwsClientPool()
+    _REPLAY_WORKER["indexer"] = rdslogcommon.BulkIndexer(
+        es,
+        max_bytes=bulk.get("BULK_MAX_BYTES", 5 * 1024 * 1024),
+        max_docs=bulk.get("BULK_MAX_DOCS", 5000),
+        concurrency=bulk.get("BULK_CONCURRENCY", 2))
+    _REPLAY_WORKER["ec2names"] = dict()
+    _REPLAY_WORKER["parsers"] = dict()
+
+
+def getReplayParser(kind, config, raw_path, ec2_cache_path):
+    key = (kind, config["RDS_ID"])
+    parser = _REPLAY_WORKER["parsers"].get(key)
+    if parser is not None:
+        return parser
+
+    ec2names = None
+    if config["AWS_EC2_VPC_ID"]:
+        ec2names = _REPLAY_WORKER["ec2names"].get(ec2_cache_path)
+        if ec2names is None:
+            ec2names = rdslogcommon.EC2NameCache(
+                ec2_cache_path, config["AWS_EC2_REGION_ID"], config["AWS_EC2_VPC_ID"], _REPLAY_WORKER["clients"])
+            _REPLAY_WORKER["ec2names"][ec2_cache_path] = ec2names
+
+    parser = RdsLogCollector.SENDERS[kind](
+        config=config,
+        es=_REPLAY_WORKER["es"],
+        clients=_REPLAY_WORKER["clients"],
+        checkpoint=rdslogcommon.MarkerCheckpoint(),
+        reaminer=rdslogcommon.RawFileRemainer(raw_path),
+        ec2names=ec2names,
+        indexer=_REPLAY_WORKER["indexer"])
+    _REPLAY_WORKER["parsers"][key] = parser
+    return parser
+
+
+# Parse and send an archived raw log in a worker process. It is a function to be pickled by multiprocessing.
+# A job has every member of one file, so the members are parsed in order by one parser and its aggregates are
+# closed once. Only the numbers of documents go back to the parent process.
+def replayRawLog(job):
+    kind, config, raw_path, ec2_cache_path, entries = job
+    started = time.time()
+    indexer = _REPLAY_WORKER["indexer"]
+    sent, failed = indexer.getStats()
+    try:
+        parser = getReplayParser(kind, config, raw_path, ec2_cache_path)
+        hour = datetime.strptime(entries[0]["hour"], "%Y-%m-%dT%H:%M:%S")
+
+        parser.replay((parser._reaminer.readRawLog(entry) for entry in entries), hour)
+        indexer.flush()
+        err = None
+    except Exception:
+        err = traceback.format_exc()
+    num_of_sent, num_of_failed = indexer.getStats()
+    return kind, entries, num_of_sent - sent, num_of_failed - failed, time.time() - started, err
+
+
+class RdsLogCollector:
+    SENDERS = {
+        "slowquery": slowquery2es.SlowquerySender,
+        "errorlog": errorlog2es.ErrorlogSender,
+    }
+
+    def __init__(self):
+        self._SENDERS = self.SENDERS
+
+        # default values in rdslog2es-config.yml
+        self._es_host = "192.168.0.1:4040"
+        self._workers = 8
+        self._timezone = "Asia/Seoul"
+        self._bulk = dict()
+        self._parse = dict()
+        self._aggregate = dict()
+        self._sample = dict()
+        self._sql = dict()
+        self._daemon = {"DAEMON_MIN_INTERVAL": 5, "DAEMON_MAX_INTERVAL": 300}
+        self._digest_mode = "both"
+        self._instances = list()
+
+        self._es = None
+        self._clients = rdslogcommon.AwsClientPool()
+        self._checkpoints = dict()
+        self._reaminers = dict()
+        self._ec2names = dict()
+        self._ec2_cache_dir = "/var/log/rdslog/ec2cache"
+        self._ec2_cache_ttl = 24
+        self._parse_pool = None
+
+    def readYaml(self, input):
+        with open(input, "r") as f:
+            return yaml.safe_load(f)
+
+    def loadConfig(self, input):
+        config = self.readYaml(input)
+
+        self._es_host = config["elasticsearch"]["host"]
+        self._workers = int(config["worker"]["size"])
+        self._timezone = config.get("timezone", self._timezone) or ""
+        self._digest_mode = config.get("digest_mode", self._digest_mode)
+
+        bulk = config.get("bulk") or dict()
+        for key, name in (("max_bytes", "BULK_MAX_BYTES"), ("max_docs", "BULK_MAX_DOCS"), ("concurrency", "BULK_CONCURRENCY")):
+            if key in bulk:
+                self._bulk[name] = int(bulk[key])
+
+        parse = config.get("parse") or dict()
+        for key, name in (("processes", "PARSE_PROCESSES"), ("chunk_bytes", "PARSE_CHUNK_BYTES")):
+            if key in parse:
+                self._parse[name] = int(parse[key])
+
+        sample = config.get("sample") or dict()
+        for key, name in (("first", "SAMPLE_FIRST"), ("reservoir", "SAMPLE_RESERVOIR"), ("slowest", "SAMPLE_SLOWEST")):
+            if key in sample:
+                self._sample[name] = int(sample[key])
+
+        sql = config.get("sql") or dict()
+        for key, name in (("prefix_length", "SQL_PREFIX_LENGTH"), ("cache_size", "SQL_CACHE_SIZE")):
+            if key in sql:
+                self._sql[name] = int(sql[key])
+
+        aggregate = config.get("aggregate") or dict()
+        for key, name in (("window_sec", "AGGREGATE_WINDOW_SEC"), ("min_count", "AGGREGATE_MIN_COUNT")):
+            if key in aggregate:
+                self._aggregate[name] = int(aggregate[key])
+
+        daemon = config.get("daemon") or dict()
+        for key, name in (("min_interval", "DAEMON_MIN_INTERVAL"), ("max_interval", "DAEMON_MAX_INTERVAL")):
+            if key in daemon:
+                self._daemon[name] = int(daemon[key])
+
+        for i in config["instances"]:
+            self._instances.append({
+                "id": i["id"],
+                "region": i["region"],
+                "ec2_region": i.get("ec2_region", i["region"]),
+                "vpc": i.get("vpc"),
+                "logs": i.get("logs", sorted(self._SENDERS.keys())),
+            })
+
+        # One shared checkpoint and raw file directory per kind of log, so that threads never overwrite each other.
+        self._checkpoints["slowquery"] = rdslogcommon.MarkerCheckpoint(config["checkpoint"]["slowquery"])
+        self._checkpoints["errorlog"] = rdslogcommon.MarkerCheckpoint(config["checkpoint"]["errorlog"])
+        self._reaminers["slowquery"] = rdslogcommon.RawFileRemainer(config["raw_output"]["slowquery"])
+        self._reaminers["errorlog"] = rdslogcommon.RawFileRemainer(config["raw_output"]["errorlog"])
+
+        ec2_cache = config.get("ec2_cache") or dict()
+        self._ec2_cache_dir = ec2_cache.get("dir", self._ec2_cache_dir)
+        self._ec2_cache_ttl = int(ec2_cache.get("ttl_hours", self._ec2_cache_ttl))
+
+        # Every bulk request in flight can hold one connection at the same time.
+        self._es = Elasticsearch(self._es_host, maxsize=self._workers * self._bulk.get("BULK_CONCURRENCY", 2))
+
+    # The cache is refreshed only once for all instances in a VPC, before workers get started.
+    def initEC2Names(self):
+        for ins in self._instances:
+            key = (ins["ec2_region"], ins["vpc"])
+            if not ins["vpc"] or key in self._ec2names:
+                continue
+
+            self._ec2names[key] = rdslogcommon.EC2NameCache(
+                self.makeEC2CachePath(ins), ins["ec2_region"], ins["vpc"], self._clients,
+                ttl=timedelta(hours=self._ec2_cache_ttl))
+            self._ec2names[key].refresh()
+
+    def makeJobs(self):
+        jobs = list()
+        for ins in self._instances:
+            for kind in ins["logs"]:
+                jobs.append((kind, ins))
+        return jobs
+
+    def makeSenderConfig(self, kind, ins):
+        config = {
+            "ES_HOST": self._es_host,
+            "RDS_ID": ins["id"],
+            "TIMEZONE": self._timezone,
+            "AWS_RDS_REGION_ID": ins["region"],
+            "AWS_EC2_REGION_ID": ins["ec2_region"],
+            "AWS_EC2_VPC_ID": ins["vpc"],
+        }
+        config.update(self._bulk)
+        config.update(self._daemon)
+        if kind == "slowquery":
+            config["DIGEST_MODE"] = self._digest_mode
+            config.update(self._parse)
+            config.update(self._sample)
+            config.update(self._sql)
+        else:
+            config.update(self._aggregate)
+        return config
+
+    def makeEC2CachePath(self, ins):
+        return "%s/%s_%s.json" % (self._ec2_cache_dir, ins["ec2_region"], ins["vpc"])
+
+    # One pool of parse processes for all instances. It is made in the main thread, before workers get started.
+    def initParsePool(self):
+        if self._parse_pool is None and self._parse.get("PARSE_PROCESSES", 1) > 1:
+            self._parse_pool = slowquery2es.makeParsePool(self._parse["PARSE_PROCESSES"])
+
+    def closeParsePool(self):
+        if self._parse_pool is not None:
+            self._parse_pool.terminate()
+            self._parse_pool.join()
+            self._parse_pool = None
+
+    def makeSender(self, kind, ins):
+        options = dict()
+        if kind == "slowquery":
+            options["parse_pool"] = self._parse_pool
+        return self._SENDERS[kind](
+            config=self.makeSenderConfig(kind, ins),
+            es=self._es,
+            clients=self._clients,
+            checkpoint=self._checkpoints[kind],
+            reaminer=self._reaminers[kind],
+            ec2names=self._ec2names.get((ins["ec2_region"], ins["vpc"])),
+            **options)
+
+    def runJob(self, job):
+        kind, ins = job
+
+        # Failure of an instance must not stop the others.
+        try:
+            return kind, ins["id"], self.makeSender(kind, ins).run(), None
+        except Exception as e:
+            traceback.print_exc()
+            return kind, ins["id"], None, e
+
+    def pollSender(self, sender):
+        try:
+            return sender.poll()
+        except Exception:
+            traceback.print_exc()
+            return False
+
+    # Daemon mode. Senders are kept, and each of them is polled again after its own adaptive interval.
+    def runForever(self):
+        self.initEC2Names()
+        self.initParsePool()
+        jobs = self.makeJobs()
+        senders = [self.makeSender(kind, ins) for kind, ins in jobs]
+        intervals = [rdslogcommon.AdaptiveInterval(self._daemon["DAEMON_MIN_INTERVAL"], self._daemon["DAEMON_MAX_INTERVAL"])
+                     for job in jobs]
+        due = [0] * len(jobs)
+        running = dict()
+
+        print("%s : Poll %d logs of %d instances with %d workers" % (
+            str(datetime.now()), len(jobs), len(self._instances), self._workers))
+
+        pool = ThreadPool(processes=self._workers)
+        try:
+            while True:
+                now = time.time()
+                for i in range(len(jobs)):
+                    if i in running:
+                        if not running[i].ready():
+                            continue
+                        due[i] = now + intervals[i].next(running.pop(i).get())
+                    elif due[i] <= now:
+                        running[i] = pool.apply_async(self.pollSender, (senders[i],))
+                time.sleep(0.5)
+        finally:
+            pool.terminate()
+            pool.join()
+            # Aggregates held by polls are sent before the daemon exits.
+            for sender in senders:
+                try:
+                    sender.stop()
+                except Exception:
+                    traceback.print_exc()
+            self.closeParsePool()
+
+    def run(self):
+        self.initEC2Names()
+        self.initParsePool()
+        jobs = self.makeJobs()
+
+        print("%s : Collect %d logs of %d instances with %d workers" % (
+            str(datetime.now()), len(jobs), len(self._instances), self._workers))
+
+        pool = ThreadPool(processes=self._workers)
+        failed = 0
+        try:
+            for kind, rds_id, ret, err in pool.imap_unordered(self.runJob, jobs):
+                if err is not None:
+                    failed += 1
+                    print("[%s] %s failed : %s" % (rds_id, kind, err))
+                else:
+                    print("[%s] %s finished : %s" % (rds_id, kind, ret))
+        finally:
+            pool.close()
+            pool.join()
+            self.closeParsePool()
+
+        print("%s : Done. %d succeeded, %d failed" % (str(datetime.now()), len(jobs) - failed, failed))
+        return failed
+
+    # Members of the same file are one job, since workers running them at once would split its aggregates.
+    def makeReplayJobs(self, ins, begin, end):
+        jobs = list()
+        for kind in ins["logs"]:
+            config = self.makeSenderConfig(kind, ins)
+            raw_path = self._reaminers[kind]._raw_path
+            hour = begin
+            while hour <= end:
+                files = collections.OrderedDict()
+                for entry in self._reaminers[kind].findRawLogs(ins["id"], hour):
+                    files.setdefault(entry["log_file"], list()).append(entry)
+                for entries in files.values():
+                    jobs.append((kind, config, raw_path, self.makeEC2CachePath(ins), entries))
+                hour += timedelta(hours=1)
+        return jobs
+
+    # Index archived raw logs of an instance again. begin and end are UTC hours, both inclusive.
+    def replay(self, rds_id, begin, end, processes=None):
+        ins = [i for i in self._instances if i["id"] == rds_id]
+        if not ins:
+            print("%s is not in the config!" % rds_id)
+            return 1
+        ins = ins[0]
+
+        # Names are refreshed once here, and workers only read the cache file.
+        self.initEC2Names()
+        jobs = self.makeReplayJobs(ins, begin, end)
+        if not jobs:
+            print("No raw log of %s from %s to %s" % (rds_id, begin, end))
+            return 0
+
+        for kind in ins["logs"]:
+            self._SENDERS[kind](
+                config=self.makeSenderConfig(kind, ins), es=self._es, clients=self._clients,
+                checkpoint=self._checkpoints[kind], reaminer=self._reaminers[kind]).initTemplate()
+
+        processes = processes or multiprocessing.cpu_count()
+        print("%s : Replay %d raw logs of %s with %d processes" % (str(datetime.now()), len(jobs), rds_id, processes))
+
+        started = time.time()
+        done, failed, sent, failed_docs, num_of_bytes = 0, 0, 0, 0, 0
+        pool = multiprocessing.Pool(processes, initReplayWorker, (self._es_host, self._bulk))
+        try:
+            for kind, entries, num_of_sent, num_of_failed, elapsed, err in pool.imap_unordered(replayRawLog, jobs):
+                done += 1
+                sent += num_of_sent
+                failed_docs += num_of_failed
+                if err is not None:
+                    failed += 1
+                    print("[%s] %s %s failed :\n%s" % (rds_id, kind, entries[0]["path"], err))
+                    continue
+
+                num_of_bytes += sum(entry["raw_bytes"] for entry in entries)
+                total_elapsed = max(time.time() - started, 0.001)
+                print("[%d/%d] %s %s : %d docs in %.1fs, total %.0f docs/s, %.1f MB/s" % (
+                    done, len(jobs), kind, entries[0]["hour"], num_of_sent, elapsed,
+                    sent / total_elapsed, num_of_bytes / total_elapsed / 1024 / 1024))
+        finally:
+            pool.close()
+            pool.join()
+
+        print("%s : Done. %d raw logs (%d failed), sent %d docs, failed %d docs in %.1fs" % (
+            str(datetime.now()), len(jobs), failed, sent, failed_docs, time.time() - started))
+        return failed + (1 if failed_docs else 0)
+
+
+# "YYYY-MM-DDTHH" is an hour, and "YYYY-MM-DD" is the first or the last hour of the day.
+def parseHour(s, last=False):
+    try:
+        return datetime.strptime(s, "%Y-%m-%dT%H")
+    except ValueError:
+        day = datetime.strptime(s, "%Y-%m-%d")
+        return day.replace(hour=23) if last else day
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", help="config", type=str, default="./rdslog2es-config.yml")
+    parser.add_argument("-d", "--daemon", dest="daemon", help="keep polling instead of a run", action="store_true")
+    # Replay mode indexes archived raw logs again, e.g. after the cluster is rebuilt.
+    parser.add_argument("--replay", dest="replay", help="instance id to replay", type=str, default=None)
+    parser.add_argument("--begin", dest="begin", help="UTC, YYYY-MM-DD or YYYY-MM-DDTHH", type=str, default=None)
+    parser.add_argument("--end", dest="end", help="UTC, YYYY-MM-DD or YYYY-MM-DDTHH (inclusive)", type=str, default=None)
+    parser.add_argument("--processes", dest="processes", help="parser processes", type=int, default=None)
+    args = parser.parse_args()
+
+    collector = RdsLogCollector()
+    collector.loadConfig(args.config)
+    if args.daemon:
+        collector.runForever()
+    elif args.replay:
+        if not args.begin:
+            parser.error("--replay needs --begin")
+        begin = parseHour(args.begin)
+        end = parseHour(args.end or args.begin, last=True)
+        failed = collector.replay(args.replay, begin, end, args.processes)
+    else:
+        failed = collector.run()
+    if failed > 0:
+        sys.exit(1)
@@ -0,0 +1,923 @@
+# -*- coding: utf-8 -*-
+
+# Project   : Common classes of slowquery2es.py, errorlog2es.py and rdslog2es.py.
+# Author    : YW. Jang
+# Date      : 2016.12.20
+#
+# Copyright 2016, YW. Jang, All rights reserved.
+
+import boto3
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from dateutil import tz, zoneinfo
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Convert UTC timestamps in the logs to TIMEZONE. The same second repeats a lot, so converted one is cached.
+class TimestampConverter:
+    def __init__(self, timezone, max_cache=4096):
+        self._UTC = tz.tzutc()
+
+        # If timezone is blank, timestamps stay in UTC without offset.
+        self._tz = zoneinfo.gettz(timezone) if timezone else None
+        self._max_cache = max_cache
+        self._cache = dict()
+
+    # "161211 10:00:01" or "161211  9:00:01" of slow query log.
+    def parseSlowLogTime(self, s):
+        day, clock = s.split()
+        hour, minute, second = clock.split(":")
+        return self.makeLocalTime(2000 + int(day[0:2]), int(day[2:4]), int(day[4:6]), int(hour), int(minute), int(second))
+
+    # "2016-12-11 10:00:01" of error log.
+    def parseErrorLogTime(self, s):
+        return self.makeLocalTime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+    def makeLocalTime(self, year, month, day, hour, minute, second):
+        timestamp = datetime(year, month, day, hour, minute, second)
+        if self._tz is None:
+            return timestamp
+        return timestamp.replace(tzinfo=self._UTC).astimezone(self._tz)
+
+    def convertSlowLogTime(self, s):
+        iso = self._cache.get(s)
+        if iso is None:
+            iso = self.cache(s, self.parseSlowLogTime(s).isoformat())
+        return iso
+
+    def convertErrorLogTime(self, s):
+        iso = self._cache.get(s)
+        if iso is None:
+            iso = self.cache(s, self.parseErrorLogTime(s).isoformat())
+        return iso
+
+    def cache(self, s, iso):
+        # Timestamps only go forward, so old ones are useless.
+        if len(self._cache) >= self._max_cache:
+            self._cache.clear()
+        self._cache[s] = iso
+        return iso
+
+
+# IP to Name map of ec2 instances in a VPC, kept on disk between runs.
+# Lookups never call AWS. Missed addresses are resolved later in a batch by resolvePending.
+class EC2NameCache:
+    def __init__(self, path, region, vpc, clients, ttl=timedelta(hours=24), refresh_interval=timedelta(minutes=10)):
+        self._MISSED = "Missed"
+        self._BATCH_SIZE = 200
+
+        self._path = path
+        self._region = region
+        self._vpc = vpc
+        self._clients = clients
+        self._ttl = ttl
+        self._refresh_interval = refresh_interval
+
+        self._names = dict()
+        # Addresses which are not in the VPC, with the time they were looked up.
+        self._missed = dict()
+        self._full_refreshed = 0
+        self._refreshed = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._resolve_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self._path):
+            return False
+
+        with open(self._path, "r") as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                print("EC2 cache is broken, so it will be refreshed : %s" % self._path)
+                return False
+        self._names = cache.get("names", dict())
+        self._missed = cache.get("missed", dict())
+        self._full_refreshed = cache.get("full_refreshed", 0)
+        self._refreshed = cache.get("refreshed", 0)
+        return True
+
+    def save(self):
+        dir_name = os.path.dirname(self._path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        with self._lock:
+            cache = {
+                "region": self._region,
+                "vpc": self._vpc,
+                "names": self._names,
+                "missed": self._missed,
+                "full_refreshed": self._full_refreshed,
+                "refreshed": self._refreshed,
+            }
+            # slowquery2es and errorlog2es may save the same cache at the same time.
+            tmp_path = self._path + ".%d.tmp" % os.getpid()
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.rename(tmp_path, self._path)
+
+    def describeInstances(self, filters):
+        names = dict()
+        client = self._clients.getClient("ec2", self._region)
+        paginator = client.get_paginator("describe_instances")
+        for page in paginator.paginate(Filters=[{"Name": "vpc-id", "Values": [self._vpc]}] + filters):
+            for reservation in page["Reservations"]:
+                for i in reservation["Instances"]:
+                    for tag in i.get("Tags") or []:
+                        if tag["Key"] == "Name" and i.get("PrivateIpAddress"):
+                            names[i["PrivateIpAddress"]] = "".join(tag["Value"].split())
+        return names
+
+    # Enumerate the whole VPC once in ttl, otherwise ask only instances launched since the last refresh.
+    def refresh(self):
+        now = time.time()
+        if now - self._refreshed < self._refresh_interval.total_seconds():
+            return
+
+        try:
+            if now - self._full_refreshed > self._ttl.total_seconds():
+                names = self.describeInstances([])
+                with self._lock:
+                    self._names = names
+                    self._missed = dict()
+                    self._full_refreshed = now
+            else:
+                day = datetime.utcfromtimestamp(self._refreshed).date()
+                days = list()
+                while day <= datetime.utcfromtimestamp(now).date():
+                    days.append(day.strftime("%Y-%m-%d*"))
+                    day += timedelta(days=1)
+                names = self.describeInstances([{"Name": "launch-time", "Values": days}])
+                with self._lock:
+                    self._names.update(names)
+                    for ip in names:
+                        self._missed.pop(ip, None)
+            self._refreshed = now
+        except Exception as e:
+            # Stale names are better than nothing.
+            print("Failed to refresh ec2 instances in %s (%s) : %s" % (self._vpc, self._region, e))
+            return
+        self.save()
+
+    # It returns None if the address has to be resolved by resolvePending.
+    def lookup(self, ip_addr):
+        with self._lock:
+            name = self._names.get(ip_addr)
+            if name is not None:
+                return name
+            if ip_addr in self._missed:
+                return self._MISSED
+            self._pending.add(ip_addr)
+            return None
+
+    def resolvePending(self):
+        # Other threads wait for the addresses being resolved, rather than taking them as missed.
+        with self._resolve_lock:
+            self.resolvePendingInBatch()
+
+    def resolvePendingInBatch(self):
+        with self._lock:
+            pending = list(self._pending)
+            self._pending = set()
+        if not pending:
+            return
+
+        names = dict()
+        try:
+            for i in range(0, len(pending), self._BATCH_SIZE):
+                names.update(self.describeInstances(
+                    [{"Name": "private-ip-address", "Values": pending[i:i + self._BATCH_SIZE]}]))
+        except Exception as e:
+            print("Failed to resolve %d addresses : %s" % (len(pending), e))
+            return
+
+        now = time.time()
+        with self._lock:
+            self._names.update(names)
+            for ip in pending:
+                if ip not in names:
+                    self._missed[ip] = now
+        self.save()
+
+    def getName(self, ip_addr):
+        return self._names.get(ip_addr, self._MISSED)
+
+
+# boto3 clients are thread-safe, so that one client per region is shared by all instances.
+class AwsClientPool:
+    def __init__(self):
+        self._clients = dict()
+        self._lock = threading.Lock()
+
+    def getClient(self, service, region):
+        key = (service, region)
+        with self._lock:
+            if key not in self._clients:
+                # The default session is not thread-safe on creating a client.
+                self._clients[key] = boto3.session.Session().client(service, region_name=region)
+            return self._clients[key]
+
+
+# Without path, checkpoints are kept only in memory, e.g. in replay which never resumes a file.
+class MarkerCheckpoint:
+    def __init__(self, path=None):
+        self.HEAD_LINES = 10
+
+        self._path = path
+        self._checkpoints = dict()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self._path or not os.path.exists(self._path):
+            return False
+
+        with open(self._path, "r") as f:
+            try:
+                self._checkpoints = json.load(f)
+            except ValueError:
+                print("Checkpoint is broken, so it will be read from the beginning : %s" % self._path)
+                self._checkpoints = dict()
+        return True
+
+    def save(self):
+        if not self._path:
+            return
+
+        dir_name = os.path.dirname(self._path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        # Write to temporary file and rename it, so that a crash never leaves half of checkpoint.
+        # The temporary file is per process, since cron runs of a shipper may overlap.
+        with self._lock:
+            tmp_path = self._path + ".%d.tmp" % os.getpid()
+            with open(tmp_path, "w") as f:
+                json.dump(self._checkpoints, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self._path)
+
+    def makeKey(self, rds_id, log_filename):
+        return rds_id + "/" + log_filename
+
+    def get(self, rds_id, log_filename):
+        return self._checkpoints.get(self.makeKey(rds_id, log_filename))
+
+    def update(self, rds_id, log_filename, **values):
+        with self._lock:
+            self._checkpoints[self.makeKey(rds_id, log_filename)] = values
+
+    # Hash only complete lines at the head, because RDS rewrites the same file name every day.
+    # The number of hashed lines is kept together, since a young file may have fewer lines.
+    def makeHeadDigest(self, data, num_lines=None):
+        lines = data.split("\n")[:-1][:num_lines or self.HEAD_LINES]
+        head = "\n".join(lines)
+        if not isinstance(head, bytes):
+            head = head.encode("utf-8")
+        return hashlib.sha1(head).hexdigest(), len(lines)
+
+
+# Download a log file page by page. The number of lines of a page follows the observed size and latency,
+# and throttling or transient errors are retried with jittered exponential backoff from the last good marker.
+class LogPortionDownloader:
+    # RDS returns at most 1MB and 10000 lines in a call.
+    MAX_BYTES = 1024 * 1024
+    MIN_LINES = 100
+    MAX_LINES = 10000
+
+    RETRYABLE_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException",
+                       "ServiceUnavailable", "InternalFailure", "InternalError", "RequestTimeout")
+    RETRYABLE_ERRORS = ("EndpointConnectionError", "ConnectionClosedError", "ReadTimeoutError",
+                        "ConnectTimeoutError", "ConnectionError", "IncompleteReadError")
+
+    def __init__(self, client, rds_id, log_filename, num_lines=500, target_bytes=512 * 1024, target_latency=2.0,
+                 max_retries=8, base_delay=0.5, max_delay=30.0):
+        self._client = client
+        self._rds_id = rds_id
+        self._log_filename = log_filename
+        self._num_lines = num_lines
+        self._target_bytes = target_bytes
+        self._target_latency = target_latency
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+        self.marker = "0"
+        self._latencies = list()
+        self._num_of_bytes = 0
+        self._num_of_retries = 0
+
+    def isRetryable(self, e):
+        code = getattr(e, "response", None) and e.response.get("Error", {}).get("Code")
+        return code in self.RETRYABLE_CODES or type(e).__name__ in self.RETRYABLE_ERRORS
+
+    # Full jitter spreads retries of many instances collected at the same time.
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt)))
+
+    def downloadPortion(self, marker, num_lines):
+        for attempt in range(self._max_retries + 1):
+            t = time.time()
+            try:
+                ret = self._client.download_db_log_file_portion(
+                    DBInstanceIdentifier=self._rds_id,
+                    LogFileName=self._log_filename,
+                    Marker=marker,
+                    NumberOfLines=num_lines)
+            except Exception as e:
+                if attempt >= self._max_retries or not self.isRetryable(e):
+                    raise
+                self._num_of_retries += 1
+                print("Retry %s from %s after %s" % (self._log_filename, marker, e))
+                self.backoff(attempt)
+                continue
+
+            self._latencies.append(time.time() - t)
+            return ret
+
+    # Aim at target_bytes per page, and shrink pages while calls are slow.
+    def adjustPageSize(self, data, latency):
+        lines = data.count("\n")
+        if lines > 0:
+            bytes_per_line = float(len(data)) / lines
+            num_lines = int(self._target_bytes / bytes_per_line)
+            if latency > self._target_latency:
+                num_lines = min(num_lines, self._num_lines // 2)
+            self._num_lines = max(self.MIN_LINES, min(self.MAX_LINES, num_lines))
+
+    def download(self, marker="0"):
+        self.marker = marker
+        while True:
+            ret = self.downloadPortion(self.marker, self._num_lines)
+            data = ret.get("LogFileData") or ""
+            self.marker = ret["Marker"]
+            self._num_of_bytes += len(data)
+            self.adjustPageSize(data, self._latencies[-1])
+
+            yield data
+
+            if not ret["AdditionalDataPending"]:
+                break
+
+    def getLogFileName(self):
+        return self._log_filename
+
+    def getStats(self):
+        if not self._latencies:
+            return "%s : no call" % self._log_filename
+        latencies = sorted(self._latencies)
+        return "%s : %d calls, %d retries, %.1f KB, latency avg %.3fs p95 %.3fs max %.3fs, last page %d lines" % (
+            self._log_filename, len(latencies), self._num_of_retries, self._num_of_bytes / 1024.0,
+            sum(latencies) / len(latencies), latencies[int(0.95 * (len(latencies) - 1))], latencies[-1],
+            self._num_lines)
+
+
+# Split pages into lines and carry a partial line over to the next page.
+def splitLines(pages):
+    rest = ""
+    for page in pages:
+        if not page:
+            continue
+        lines = (rest + page).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+# Pages of a file downloaded ahead. Up to max_bytes stay in memory, and the rest is spilled to a temporary file.
+class PageSpool:
+    def __init__(self, max_bytes):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_bytes)
+        self._lengths = list()
+
+    def write(self, page):
+        data = page.encode("utf-8")
+        self._file.write(data)
+        self._lengths.append(len(data))
+
+    # Pages are read back one at a time, and the spool is closed after the last one.
+    def read(self):
+        self._file.seek(0)
+        try:
+            for length in self._lengths:
+                yield self._file.read(length).decode("utf-8")
+        finally:
+            self.close()
+
+    def close(self):
+        self._file.close()
+
+
+# Poll interval which is halved when new data arrived, and doubled while idle.
+class AdaptiveInterval:
+    def __init__(self, min_interval, max_interval, factor=2.0):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._factor = factor
+        self._interval = min_interval
+
+    def next(self, active):
+        if active:
+            self._interval = max(self._min_interval, self._interval / self._factor)
+        else:
+            self._interval = min(self._max_interval, self._interval * self._factor)
+        return self._interval
+
+
+# Run a generator in its own thread and hand its items over through a bounded queue.
+# busy is the time spent in the generator, and blocked is the time waiting for the next stage.
+class PipelineStage:
+    def __init__(self, name, source, max_size):
+        self._END = object()
+
+        self._name = name
+        self._source = source
+        self._queue = queue.Queue(max_size)
+        self._max_size = max_size
+        self._stopped = threading.Event()
+        self._error = None
+
+        self._num_of_items = 0
+        self._max_depth = 0
+        self._busy = 0.0
+        self._blocked = 0.0
+        self._started = time.time()
+        self._finished = None
+
+        self._thread = threading.Thread(target=self.produce, name="pipeline-" + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def produce(self):
+        try:
+            it = iter(self._source)
+            while not self._stopped.is_set():
+                t = time.time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                self._busy += time.time() - t
+                self._num_of_items += 1
+                self.put(item)
+        except Exception as e:
+            self._error = e
+        finally:
+            # A generator has to be closed by the thread which runs it.
+            if hasattr(self._source, "close"):
+                self._source.close()
+            self._finished = time.time()
+            self.put(self._END)
+
+    def put(self, item):
+        t = time.time()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self._blocked += time.time() - t
+        self._max_depth = max(self._max_depth, self._queue.qsize())
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    # Stop producing, e.g. when the next stage failed, and wait for the thread.
+    def close(self):
+        self._stopped.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def getStats(self):
+        elapsed = max((self._finished or time.time()) - self._started, 0.001)
+        return "%s : %d items, %.1f items/s, busy %.1fs, blocked %.1fs, queue %d/%d (max %d)" % (
+            self._name, self._num_of_items, self._num_of_items / elapsed, self._busy, self._blocked,
+            self._queue.qsize(), self._max_size, self._max_depth)
+
+
+# Batch documents by size and count, and drain the buffer whenever it is sent.
+class BulkIndexer:
+    def __init__(self, es, max_bytes=5 * 1024 * 1024, max_docs=5000, concurrency=1, max_retries=3):
+        self._es = es
+        self._max_bytes = max_bytes
+        self._max_docs = max_docs
+        self._concurrency = max(1, concurrency)
+        self._max_retries = max_retries
+
+        self._lines = list()
+        self._num_of_bytes = 0
+        self._num_of_docs = 0
+
+        # Requests in flight are bounded by the semaphore.
+        self._pool = None
+        self._inflight = threading.BoundedSemaphore(self._concurrency)
+        self._lock = threading.Lock()
+        self._errors = list()
+
+        self._num_of_sent_doc = 0
+        self._num_of_failed_doc = 0
+        self._num_of_requests = 0
+        self._num_of_inflight = 0
+        self._busy = 0.0
+        self._blocked = 0.0
+        self._started = time.time()
+
+    def append(self, action, source):
+        self.appendLines(json.dumps(action), json.dumps(source))
+
+    def appendLines(self, action_line, source_line):
+        self._lines.append(action_line)
+        self._lines.append(source_line)
+        self._num_of_bytes += len(action_line) + len(source_line) + 2
+        self._num_of_docs += 1
+
+        if self._num_of_bytes >= self._max_bytes or self._num_of_docs >= self._max_docs:
+            self.sendBuffer()
+
+    def sendBuffer(self, refresh=False):
+        if not self._lines:
+            return
+
+        lines = self._lines
+        self._lines = list()
+        self._num_of_bytes = 0
+        self._num_of_docs = 0
+
+        if self._concurrency == 1:
+            self.sendBulk(lines, refresh)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPool(processes=self._concurrency)
+        t = time.time()
+        self._inflight.acquire()
+        self._blocked += time.time() - t
+        with self._lock:
+            self._num_of_inflight += 1
+        self._pool.apply_async(self.sendBulkAsync, (lines, refresh))
+
+    def sendBulkAsync(self, lines, refresh):
+        try:
+            self.sendBulk(lines, refresh)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+        finally:
+            with self._lock:
+                self._num_of_inflight -= 1
+            self._inflight.release()
+
+    def sendBulk(self, lines, refresh=False):
+        for attempt in range(self._max_retries + 1):
+            t = time.time()
+            response = self._es.bulk(body="\n".join(lines) + "\n", refresh=refresh)
+            with self._lock:
+                self._num_of_requests += 1
+                self._busy += time.time() - t
+            lines = self.checkResponse(lines, response, attempt < self._max_retries)
+            if not lines:
+                return
+            # Back off while elastic search rejects requests due to its full queue.
+            time.sleep(2 ** attempt)
+
+    # It returns the lines which have to be retried.
+    def checkResponse(self, lines, response, retry):
+        retry_lines = list()
+        num_of_failed = 0
+
+        if response.get("errors"):
+            for i, item in enumerate(response["items"]):
+                result = list(item.values())[0]
+                if "error" not in result:
+                    continue
+
+                if result.get("status") == 429 and retry:
+                    retry_lines.extend(lines[2 * i:2 * i + 2])
+                else:
+                    num_of_failed += 1
+                    if num_of_failed <= 3:
+                        print("Bulk item failed (%s) : %s" % (result.get("status"), result["error"]))
+
+        with self._lock:
+            self._num_of_sent_doc += len(lines) // 2 - len(retry_lines) // 2 - num_of_failed
+            self._num_of_failed_doc += num_of_failed
+        return retry_lines
+
+    # Send the rest and wait for all requests in flight.
+    def flush(self, refresh=False):
+        self.sendBuffer(refresh)
+
+        for i in range(self._concurrency):
+            self._inflight.acquire()
+        for i in range(self._concurrency):
+            self._inflight.release()
+
+        with self._lock:
+            errors = self._errors
+            self._errors = list()
+        if errors:
+            raise errors[0]
+
+    def close(self, refresh=False):
+        try:
+            self.flush(refresh)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def getStats(self):
+        return self._num_of_sent_doc, self._num_of_failed_doc
+
+    # busy is the sum of time in bulk requests, and blocked is the time waiting for a request in flight.
+    def getCounters(self):
+        elapsed = max(time.time() - self._started, 0.001)
+        with self._lock:
+            return {
+                "requests": self._num_of_requests,
+                "docs_per_sec": self._num_of_sent_doc / elapsed,
+                "busy": self._busy,
+                "blocked": self._blocked,
+                "inflight": self._num_of_inflight,
+                "concurrency": self._concurrency,
+            }
+
+
+class DirectoryManager:
+    def __init__(self, path="/var/log"):
+        self._raw_path = path
+
+    def readInputPath(self, input_path):
+        input_files = list()
+
+        if os.path.isfile(input_path):
+            input_files.append(input_path)
+        else:
+            for (dirpath, dirnames, filelist) in os.walk(input_path):
+                for fname in filelist:
+                    input_files.append(dirpath + "/" + fname)
+        return input_files
+
+    def readDatePath(self, date_path):
+        date_file_list = glob.glob(date_path + "/[0-9]*/[0-9]*/[0-9]*")
+        date_path_list = filter(lambda d: os.path.isdir(d), date_file_list)
+
+        return map(self.regularizePath, date_path_list)
+
+    def regularizePath(self, s):
+        return re.sub("[\\\|/]+", "/", s)
+
+    def mkdir(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def rmdir(self, path):
+        # It prevents from deleting all your disk files.
+        if path == "/" or not os.path.exists(path):
+            return False
+
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                print('remove: ' + os.path.join(root, name))
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                print('removedir: ' + os.path.join(root, name))
+                os.removedirs(os.path.join(root, name))
+        return True
+
+    def isEmptyDir(self, dir):
+        if os.path.exists(dir) and os.listdir(dir) == []:
+            return True
+        else:
+            return False
+
+
+class RawFileRemainer(DirectoryManager):
+    # Raw logs are appended as gzip members to one file per instance, log file and day.
+    # Every member is recorded in the manifest, so that neither retention nor lookup walks the directories.
+    MANIFEST_NAME = "manifest.jsonl"
+
+    def __init__(self, path, due_date=timedelta(weeks=2)):
+        DirectoryManager.__init__(self, path)
+        self._due_date = due_date
+        self._cleared_date = None
+        self._lock = threading.Lock()
+        self._manifest_path = self._raw_path + "/" + self.MANIFEST_NAME
+        self._index = None
+
+    def makeLogHour(self, log_filename, now=None):
+        # mysql-slowquery.log.N is the hour N of UTC in last 24 hours. The live file without the hour is never read,
+        # since its data is sent from the hourly file.
+        now = (now or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+        m = re.search("\\.(\\d{4}-\\d{2}-\\d{2})\\.(\\d{1,2})$", log_filename)
+        if m:
+            return datetime.strptime(m.group(1), "%Y-%m-%d").replace(hour=int(m.group(2)))
+        m = re.search("\\.(\\d{1,2})$", log_filename)
+        if m:
+            hour = now.replace(hour=int(m.group(1)))
+            return hour if hour <= now else hour - timedelta(days=1)
+        raise ValueError("No hour in the name of log file : %s" % log_filename)
+
+    def makeKey(self, instance, hour):
+        return "%s:%s" % (instance, hour.strftime("%Y%m%d%H"))
+
+    def loadManifest(self):
+        index = dict()
+        if not os.path.exists(self._manifest_path):
+            return index
+
+        with open(self._manifest_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line can be cut by a crash while appending.
+                    continue
+                index.setdefault(entry["key"], list()).append(entry)
+        return index
+
+    def getIndex(self):
+        with self._lock:
+            if self._index is None:
+                self._index = self.loadManifest()
+            return self._index
+
+    def addManifest(self, entry):
+        self.getIndex()
+        with self._lock:
+            self.mkdir(self._raw_path)
+            with open(self._manifest_path, "a") as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._index.setdefault(entry["key"], list()).append(entry)
+
+    def findRawLogs(self, instance, hour):
+        hour = hour.replace(minute=0, second=0, microsecond=0)
+        return list(self.getIndex().get(self.makeKey(instance, hour), list()))
+
+    def readRawLog(self, entry):
+        with open(self._raw_path + "/" + entry["path"], "rb") as f:
+            f.seek(entry["offset"])
+            data = gzip.GzipFile(fileobj=io.BytesIO(f.read(entry["length"]))).read()
+
+        if hashlib.sha1(data).hexdigest() != entry["sha1"]:
+            raise ValueError("Checksum mismatch of raw log : %s at %d" % (entry["path"], entry["offset"]))
+        return data.decode("utf-8")
+
+    def clearOutOfDateRawFiles(self):
+        # It is shared by many instances in fleet mode, so clear only once a day.
+        with self._lock:
+            if self._cleared_date == date.today():
+                return
+            self._cleared_date = date.today()
+
+            # Other processes may have appended to the manifest since it was loaded.
+            index = self.loadManifest()
+            expired = set()
+            for key in list(index.keys()):
+                entries = index[key]
+                if self.isOutOfDate(*[int(v) for v in entries[0]["hour"][:10].split("-")]):
+                    expired.update(e["path"] for e in entries)
+                    del index[key]
+            if not expired:
+                self._index = index
+                return
+
+            self.saveManifest(index)
+            self._index = index
+
+        for path in sorted(expired):
+            print("delete : " + path)
+            self.removeRawFile(self._raw_path + "/" + path)
+
+    def saveManifest(self, index):
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for key in sorted(index.keys()):
+                for entry in index[key]:
+                    f.write(json.dumps(entry, sort_keys=True) + "\n")
+        os.rename(tmp_path, self._manifest_path)
+
+    def isOutOfDate(self, year, month, day):
+        target = date(year, month, day)
+        if (date.today() - target) > self._due_date:
+            return True
+        else:
+            return False
+
+    def removeRawFile(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+        # Remove day, month and year directories if they become empty.
+        parent = os.path.dirname(path)
+        for i in range(3):
+            if not self.isEmptyDir(parent):
+                break
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+    def openRawLog(self, instance, log_filename):
+        hour = self.makeLogHour(log_filename)
+        name = "%s_%s.gz" % (instance, os.path.basename(log_filename))
+        path = hour.strftime("%Y/%m/%d/") + name
+
+        self.mkdir(self._raw_path + hour.strftime("/%Y/%m/%d"))
+        print("%s : Remain raw log data : %s" % (str(datetime.now()), self._raw_path + "/" + path))
+        return RawLogSegment(self, path, {
+            "key": self.makeKey(instance, hour),
+            "instance": instance,
+            "log_file": log_filename,
+            "hour": hour.isoformat(),
+        })
+
+    def makeRawLog(self, instance, log_filename, raw_data):
+        f = self.openRawLog(instance, log_filename)
+        try:
+            f.write(raw_data)
+        finally:
+            f.close()
+
+
+# A gzip member appended to an archive file while pages are downloaded.
+class RawLogSegment(object):
+    def __init__(self, remainer, path, entry):
+        self._remainer = remainer
+        self._entry = entry
+        self._entry["path"] = path
+        self._entry["begin"] = datetime.utcnow().isoformat()
+        self._sha1 = hashlib.sha1()
+        self._raw_bytes = 0
+        self._file = None
+        self._gzip = None
+        self._closed = False
+
+    # The archive file is opened with the first data, so that an empty download leaves nothing.
+    def open(self):
+        self._file = open(self._remainer._raw_path + "/" + self._entry["path"], "ab")
+        self._file.seek(0, os.SEEK_END)
+        self._offset = self._file.tell()
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def write(self, data):
+        if not data or self._closed:
+            return
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        if self._gzip is None:
+            self.open()
+        self._gzip.write(data)
+        self._sha1.update(data)
+        self._raw_bytes += len(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._gzip is None:
+            return
+
+        self._gzip.close()
+        length = self._file.tell() - self._offset
+        self._file.close()
+
+        self._entry.update({
+            "end": datetime.utcnow().isoformat(),
+            "offset": self._offset,
+            "length": length,
+            "raw_bytes": self._raw_bytes,
+            "sha1": self._sha1.hexdigest(),
+        })
+        self._remainer.addManifest(self._entry)
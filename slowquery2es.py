@@ -6,23 +6,39 @@
 #
 # Copyright 2016, YW. Jang, All rights reserved.
 
-import boto3
-import glob
+import argparse
+import calendar
+import collections
+import copy
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import random
 import re
 import time
+import traceback
 
-from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from dateutil import tz, zoneinfo
+from multiprocessing.pool import ThreadPool
 
 from elasticsearch import Elasticsearch
 
+from rdslogcommon import AdaptiveInterval, AwsClientPool, BulkIndexer, EC2NameCache, LogPortionDownloader
+from rdslogcommon import MarkerCheckpoint, PageSpool, PipelineStage, RawFileRemainer, TimestampConverter, splitLines
+
 
 class SlowquerySender:
-    def __init__(self):
+    # In fleet mode, config overrides _GENERAL_CONFIG per instance and the others are shared.
+    # A parser of parallel parsing is parse_only, and has neither Elasticsearch, raw archive nor checkpoint file.
+    def __init__(self, config=None, es=None, clients=None, checkpoint=None, reaminer=None, ec2names=None, indexer=None,
+                 parse_pool=None, parse_only=False):
         self._SLOWQUERYLOG_PREFIX = "slowquery/mysql-slowquery.log."
+        self._WATERMARK = "watermark"
 
         self._GENERAL_CONFIG = {
             # Elasticsearch host name
@@ -42,8 +58,53 @@ class SlowquerySender:
 
             # If you have ec2 instances, then It need region and VPC involving instances.
             "AWS_EC2_REGION_ID": "ap-northeast-2",
-            "AWS_EC2_VPC_ID": "vpc-XXxxXXxx"
+            "AWS_EC2_VPC_ID": "vpc-XXxxXXxx",
+            # The whole VPC is enumerated once in this hours, otherwise only new instances.
+            "EC2_CACHE_TTL_HOURS": 24,
+
+            # A bulk request is sent when either of size or count is exceeded.
+            "BULK_MAX_BYTES": 5 * 1024 * 1024,
+            "BULK_MAX_DOCS": 5000,
+            "BULK_CONCURRENCY": 2,
+
+            # raw : every slow query, digest : summary per fingerprint, user and client, both : raw and digest
+            "DIGEST_MODE": "both",
+
+            # Latency histogram of query_time per fingerprint and time bucket, aligned to epoch. (0 means disabled)
+            "HISTOGRAM_INTERVAL_MINUTES": 60,
+            "HISTOGRAM_MAX_SKETCHES": 10000,
+
+            # Raw slow queries per fingerprint in an hourly file : the first SAMPLE_FIRST ones, a uniform sample of
+            # SAMPLE_RESERVOIR among the rest and always the slowest SAMPLE_SLOWEST. Each has sample_weight.
+            # Digests and histograms count every entry. (0 reservoir means every entry is sent)
+            "SAMPLE_FIRST": 1000,
+            "SAMPLE_RESERVOIR": 1000,
+            "SAMPLE_SLOWEST": 100,
+
+            # SQL longer than SQL_PREFIX_LENGTH is indexed once per hash into INDEX_PREFIX_sql, and slow queries carry
+            # only its prefix and sql_hash. Hashes sent recently are remembered up to SQL_CACHE_SIZE. (0 means disabled)
+            "SQL_PREFIX_LENGTH": 256,
+            "SQL_CACHE_SIZE": 100000,
+
+            # A log larger than two chunks is parsed by this number of processes. (1 means in this process)
+            "PARSE_PROCESSES": 1,
+            "PARSE_CHUNK_BYTES": 16 * 1024 * 1024,
+
+            # Download, parse and enrich run in their own threads, with bounded queues of pages or batches of docs.
+            "PIPELINE_QUEUE_SIZE": 8,
+            "PIPELINE_BATCH_DOCS": 500,
+
+            # Hourly files missed by late or failed runs are downloaded ahead by this number of threads.
+            # Each of them keeps up to CATCHUP_MEMORY_BYTES in memory, and the rest in a temporary file.
+            "CATCHUP_CONCURRENCY": 2,
+            "CATCHUP_MEMORY_BYTES": 8 * 1024 * 1024,
+
+            # Poll interval of daemon mode in seconds. It shortens while new data is arriving and lengthens while idle.
+            "DAEMON_MIN_INTERVAL": 5,
+            "DAEMON_MAX_INTERVAL": 300
         }
+        if config:
+            self._GENERAL_CONFIG.update(config)
 
         self._REGEX4REFINE = {
             "REG_TIME": re.compile(
@@ -52,89 +113,240 @@ class SlowquerySender:
 
         self._LOG_CONFIG = {
             "LOG_OUTPUT_DIR": "/var/log/rdslog/slowquery2es.log",
-            "RAW_OUTPUT_DIR": "/var/log/rdslog/slowquery"  # (Optional)
+            "RAW_OUTPUT_DIR": "/var/log/rdslog/slowquery",  # (Optional)
+
+            # Last read marker of each log file, so that only new tail is downloaded.
+            "CHECKPOINT_PATH": "/var/log/rdslog/slowquery2es.checkpoint",
+
+            # IP to Name map of ec2 instances per region and VPC.
+            "EC2_CACHE_DIR": "/var/log/rdslog/ec2cache"
         }
 
-        self._es = Elasticsearch(self._GENERAL_CONFIG["ES_HOST"])
-        self._ec2dict = dict()
+        self._es = None
+        if not parse_only:
+            self._es = es or Elasticsearch(self._GENERAL_CONFIG["ES_HOST"])
+        self._clients = clients or AwsClientPool()
+        self._ec2names = ec2names
+        self._unresolved = list()
         self._last_time = ""
-        self._data = list()
+        self._indexer = None
+        if not parse_only:
+            self._indexer = indexer or BulkIndexer(
+                self._es,
+                max_bytes=self._GENERAL_CONFIG["BULK_MAX_BYTES"],
+                max_docs=self._GENERAL_CONFIG["BULK_MAX_DOCS"],
+                concurrency=self._GENERAL_CONFIG["BULK_CONCURRENCY"])
         self._new_doc = True
         self._num_of_total_doc = 0
         self._now = datetime.now()
 
-        self._reaminer = RawFileRemainer(self._LOG_CONFIG["RAW_OUTPUT_DIR"])
+        self._timestamps = TimestampConverter(self._GENERAL_CONFIG["TIMEZONE"])
+        self._fingerprinter = QueryFingerprinter()
+        self._aggregator = DigestAggregator()
+        self._histograms = None
+        if self._GENERAL_CONFIG["HISTOGRAM_INTERVAL_MINUTES"]:
+            self._histograms = HistogramAggregator(
+                self._GENERAL_CONFIG["HISTOGRAM_INTERVAL_MINUTES"],
+                self._GENERAL_CONFIG["HISTOGRAM_MAX_SKETCHES"])
+
+        self._sampler = None
+        if self._GENERAL_CONFIG["SAMPLE_RESERVOIR"]:
+            self._sampler = QuerySampler(
+                self._GENERAL_CONFIG["SAMPLE_FIRST"],
+                self._GENERAL_CONFIG["SAMPLE_RESERVOIR"],
+                self._GENERAL_CONFIG["SAMPLE_SLOWEST"])
+
+        self._sql_texts = None
+        self._ES_SQL_INDEX = None
+        if self._GENERAL_CONFIG["SQL_CACHE_SIZE"]:
+            self._sql_texts = SqlTextCache(self._GENERAL_CONFIG["SQL_PREFIX_LENGTH"], self._GENERAL_CONFIG["SQL_CACHE_SIZE"])
+
+        self._reaminer = None
+        if not parse_only:
+            self._reaminer = reaminer or RawFileRemainer(self._LOG_CONFIG["RAW_OUTPUT_DIR"])
+        self._checkpoint = checkpoint or MarkerCheckpoint(None if parse_only else self._LOG_CONFIG["CHECKPOINT_PATH"])
+        self._parse_pool = parse_pool
+        self._marker = "0"
+        self._head_digest = ("", 0)
+
+        # Digests, histograms and samples of a file are held across polls of daemon mode until the file or its hour is closed.
+        self._started = False
+        self._daemon = False
+        self._held_file = None
+        self._held_hour = None
+        self._HOUR_GRACE = timedelta(minutes=10)
+        # The newest file keeps one archive segment across polls, so that it is one gzip member and one manifest entry.
+        # Pages of a poll are spooled, and appended to it only after the poll has sent them.
+        self._raw_file = None
+        self._raw_key = None
+        self._raw_pages = None
+        self._saved_aggregates = None
+
+    def getRdsClient(self):
+        return self._clients.getClient("rds", self._GENERAL_CONFIG["AWS_RDS_REGION_ID"])
 
     # Get raw data.
-    def getRdsSlowQlog(self, log_filename):
-        client = boto3.client("rds", region_name=self._GENERAL_CONFIG["AWS_RDS_REGION_ID"])
-        db_files = client.describe_db_log_files(DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"])
-
-        if not filter(lambda log: log["LogFileName"] == log_filename, db_files["DescribeDBLogFiles"]):
-            return ""
-
-        marker = "0"
-        log_data = ""
-
-        # It used like do-while statement.
-        ret = client.download_db_log_file_portion(
+    # Hourly files written since the watermark, in order of time. Unchanged ones are skipped by resumeMarker.
+    def listRdsSlowQlogs(self):
+        client = self.getRdsClient()
+        watermark = self.loadWatermark()
+        db_files = client.describe_db_log_files(
             DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"],
-            LogFileName=log_filename,
-            Marker=marker,
-            NumberOfLines=500)
-        log_data = ret["LogFileData"]
-        marker = ret["Marker"]
-
-        while ret["AdditionalDataPending"]:
-            ret = client.download_db_log_file_portion(
-                DBInstanceIdentifier=self._GENERAL_CONFIG["RDS_ID"],
-                LogFileName=log_filename,
-                Marker=marker,
-                NumberOfLines=500)
-            print("keep going...")
-
-            log_data += ret["LogFileData"]
-            marker = ret["Marker"]
-
+            FilenameContains="mysql-slowquery",
+            FileLastWritten=watermark)
+
+        # Only hourly files are read. The live file has the same data, and its marker is lost when it is rotated.
+        hourly_re = re.compile(re.escape(self._SLOWQUERYLOG_PREFIX) + "\\d+$")
+        log_files = [log for log in db_files["DescribeDBLogFiles"]
+                     if hourly_re.match(log["LogFileName"]) and log["LastWritten"] >= watermark]
+        return sorted(log_files, key=lambda log: log["LastWritten"])
+
+    # LastWritten of the newest file which has been sent completely. (milliseconds since epoch)
+    def loadWatermark(self):
+        cp = self._checkpoint.get(self._GENERAL_CONFIG["RDS_ID"], self._WATERMARK)
+        if cp:
+            return cp["last_written"]
+        # At the first run, only files of recent hours are read as before.
+        return int((time.time() - 2 * 3600) * 1000)
+
+    def saveWatermark(self, log_file):
+        self._checkpoint.update(self._GENERAL_CONFIG["RDS_ID"], self._WATERMARK, last_written=log_file["LastWritten"])
+        self._checkpoint.save()
+
+    def getRdsSlowQlogHead(self, log_filename, num_lines):
+        downloader = LogPortionDownloader(self.getRdsClient(), self._GENERAL_CONFIG["RDS_ID"], log_filename)
+        ret = downloader.downloadPortion("0", num_lines)
+        return ret.get("LogFileData") or ""
+
+    # Decide where to start downloading. It returns None as marker if nothing has been appended,
+    # and the checkpoint only when it is resumed from the middle.
+    def resumeMarker(self, log_file):
+        cp = self._checkpoint.get(self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"])
+        if not cp:
+            return "0", None
+
+        if log_file["Size"] == cp["size"] and log_file["LastWritten"] == cp["last_written"]:
+            return None, None
+        if log_file["Size"] < cp["size"] or not cp.get("head_lines"):
+            return "0", None
+
+        # The same file name is reused a day later, so compare the head of it unless it is written within an hour.
+        if log_file["LastWritten"] - cp["last_written"] < 3600 * 1000:
+            return cp["marker"], cp
+        head = self.getRdsSlowQlogHead(log_file["LogFileName"], cp["head_lines"])
+        if self._checkpoint.makeHeadDigest(head, cp["head_lines"]) != (cp["digest"], cp["head_lines"]):
+            return "0", None
+        return cp["marker"], cp
+
+    # Yield raw data page by page, so that the whole file never stays in memory.
+    # It does not touch the state of a run, because older files are downloaded ahead in other threads.
+    def getRdsSlowQlog(self, downloader, marker="0", held=False):
         # Delete old log files.
         self._reaminer.clearOutOfDateRawFiles()
-        self._reaminer.makeRawLog("mysql-slowquery.log." + str((datetime.now().utcnow()).hour), log_data)
-        return log_data
-
-    def getRdsSlowQlog4Debug(self, path):
-        content = ""
+        if held:
+            raw_file = self.openHeldRawLog(downloader.getLogFileName())
+            if self._raw_pages is None:
+                self._raw_pages = PageSpool(self._GENERAL_CONFIG["CATCHUP_MEMORY_BYTES"])
+            raw_file = self._raw_pages
+        else:
+            raw_file = self._reaminer.openRawLog(self._GENERAL_CONFIG["RDS_ID"], downloader.getLogFileName())
+
+        try:
+            for page in downloader.download(marker):
+                raw_file.write(page)
+                yield page
+        finally:
+            if not held:
+                raw_file.close()
+
+    # It is called while the newest file is streamed, so the segment of the file held before is closed here.
+    def openHeldRawLog(self, log_filename):
+        key = (log_filename, self._reaminer.makeLogHour(log_filename))
+        if self._raw_file is not None and self._raw_key != key:
+            self.closeRawLog()
+        if self._raw_file is None:
+            self._raw_file = self._reaminer.openRawLog(self._GENERAL_CONFIG["RDS_ID"], log_filename)
+            self._raw_key = key
+        return self._raw_file
+
+    def commitRawLog(self):
+        if self._raw_pages is None:
+            return
+
+        for page in self._raw_pages.read():
+            self._raw_file.write(page)
+        self._raw_pages = None
+
+    def closeRawLog(self):
+        self.dropRawLog()
+        if self._raw_file is None:
+            return
+
+        self._raw_file.close()
+        self._raw_file = None
+        self._raw_key = None
+
+    def makeDownloader(self, log_file):
+        return LogPortionDownloader(self.getRdsClient(), self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"])
+
+    def fetchRdsSlowQlog(self, log_file, marker):
+        downloader = self.makeDownloader(log_file)
+        spool = PageSpool(self._GENERAL_CONFIG["CATCHUP_MEMORY_BYTES"])
+        try:
+            for page in self.getRdsSlowQlog(downloader, marker):
+                spool.write(page)
+        except Exception:
+            spool.close()
+            raise
+        return downloader, spool
+
+    # Yield (log_file, marker, cp, downloader, pages) in order of time. Files except the newest one are
+    # downloaded ahead by CATCHUP_CONCURRENCY threads, and the newest one is streamed.
+    def prefetchRdsSlowQlogs(self, plans):
+        older = plans[:-1]
+        pending = collections.deque()
+        pool = None
+        if older:
+            pool = ThreadPool(processes=self._GENERAL_CONFIG["CATCHUP_CONCURRENCY"])
+        try:
+            i = 0
+            while i < len(older) or pending:
+                while i < len(older) and len(pending) < self._GENERAL_CONFIG["CATCHUP_CONCURRENCY"]:
+                    log_file, marker, cp = older[i]
+                    pending.append((older[i], pool.apply_async(self.fetchRdsSlowQlog, (log_file, marker))))
+                    i += 1
+
+                (log_file, marker, cp), result = pending.popleft()
+                downloader, spool = result.get()
+                yield log_file, marker, cp, downloader, spool.read()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            # Spools downloaded ahead but not read, e.g. after a failure.
+            for plan, result in pending:
+                if result.ready() and result.successful():
+                    result.get()[1].close()
+
+        log_file, marker, cp = plans[-1]
+        downloader = self.makeDownloader(log_file)
+        yield log_file, marker, cp, downloader, self.getRdsSlowQlog(downloader, marker, held=True)
+
+    def getRdsSlowQlog4Debug(self, path, chunk_size=1024 * 1024):
         import codecs
         f = codecs.open(path, "r", "utf-8")
-        while True:
-            l = f.readline()
-            content += l
-            if not l: break
-        return content
-
-    def validateLogDate(self, lines):
-        delta = timedelta(hours=2)
-
-        for line in lines:
-            if not line:
-                continue
-            elif line.startswith("# Time: "):
-                log_time = datetime.strptime(line[8:], "%y%m%d %H:%M:%S")
-                log_time = log_time.replace(tzinfo=tz.tzutc()).astimezone(
-                    zoneinfo.gettz(self._GENERAL_CONFIG["TIMEZONE"]))
-                log_time = log_time.replace(tzinfo=None)
-                print(self._now, log_time)
-                print("diff :", self._now - log_time)
-                if (self._now - log_time) > delta:
-                    return False
-                else:
-                    return True
-
-        return True
+        try:
+            while True:
+                page = f.read(chunk_size)
+                if not page: break
+                yield page
+        finally:
+            f.close()
 
     # Initialization.
     def initLastTime(self, path):
         if not os.path.exists(path):
-            cur_time = dself._now.strftime("%y%m%d %H:%M:%S")
+            cur_time = self._now.strftime("%y%m%d %H:%M:%S")
             self._last_time = datetime.strptime(cur_time, "%y%m%d %H:%M:%S").isoformat()
             return False
 
@@ -156,34 +368,72 @@ class SlowquerySender:
         self._last_time = datetime.strptime(cur_time, "%y%m%d %H:%M:%S").isoformat()
         return False
 
-    def initEC2InstancesInVpc(self, region, vpc):
-        for attempt in range(3):
-            try:
-                ec2 = boto3.resource("ec2", region_name=region)
-                vpc = ec2.Vpc(vpc)
-                for i in vpc.instances.all():
-                    for tag in i.tags:
-                        if tag['Key'] == 'Name':
-                            self._ec2dict[i.private_ip_address] = "".join(tag['Value'].split())
-            except:
-                time.sleep(3)
-                print("sleeping..., because DescribeInstances have been failed.")
-            else:
-                break
+    def initEC2Names(self):
+        if not self._GENERAL_CONFIG["AWS_EC2_VPC_ID"]:
+            return
+
+        path = "%s/%s_%s.json" % (
+            self._LOG_CONFIG["EC2_CACHE_DIR"],
+            self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
+            self._GENERAL_CONFIG["AWS_EC2_VPC_ID"])
+        self._ec2names = EC2NameCache(
+            path,
+            self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
+            self._GENERAL_CONFIG["AWS_EC2_VPC_ID"],
+            self._clients,
+            ttl=timedelta(hours=self._GENERAL_CONFIG["EC2_CACHE_TTL_HOURS"]))
+        self._ec2names.refresh()
+
+    def lookupEC2Name(self, ip_addr):
+        if self._ec2names is None:
+            return "Missed"
+        return self._ec2names.lookup(ip_addr)
+
+    # Hold documents whose client is unknown, and resolve them at once.
+    def holdDoc(self, doc):
+        self._unresolved.append(doc)
+        if len(self._unresolved) >= 1000:
+            self.releaseDocs()
+
+    def releaseDocs(self):
+        if not self._unresolved:
+            return
+
+        self._ec2names.resolvePending()
+        unresolved = self._unresolved
+        self._unresolved = list()
+        for doc in unresolved:
+            doc.name = self._ec2names.getName(doc.client)
+            self.appendDoc2Data(doc)
 
     def setTargetIndex(self):
         self._ES_INDEX = self._GENERAL_CONFIG["INDEX_PREFIX"] + "-" + datetime.strftime(self._now, "%Y.%m")
+        self._ES_DIGEST_INDEX = self._GENERAL_CONFIG["INDEX_PREFIX"] + "_digest-" + datetime.strftime(self._now, "%Y.%m")
+        self._ES_HISTOGRAM_INDEX = self._GENERAL_CONFIG["INDEX_PREFIX"] + "_histogram-" + datetime.strftime(self._now, "%Y.%m")
+
+        # Every monthly index needs its own SQL texts.
+        sql_index = self._GENERAL_CONFIG["INDEX_PREFIX"] + "_sql-" + datetime.strftime(self._now, "%Y.%m")
+        if self._sql_texts is not None and sql_index != self._ES_SQL_INDEX:
+            self._sql_texts.clear()
+        self._ES_SQL_INDEX = sql_index
+
+        # Action lines are the same for every document, so serialize them once.
+        self._ES_ACTIONS = dict()
+        for key, index in (("raw", self._ES_INDEX), ("digest", self._ES_DIGEST_INDEX)):
+            self._ES_ACTIONS[key] = json.dumps({"index": {
+                "_index": index,
+                "_type": self._GENERAL_CONFIG["RDS_ID"]}})
 
     def createTemplate(self, template_name):
         template_body = {
-            "template": "test_slowquerylog-*",
+            "template": self._GENERAL_CONFIG["INDEX_PREFIX"] + "-*",
             "mappings": {
                 self._GENERAL_CONFIG["RDS_ID"]: {
                     "properties": {
                         "query_time": {
                             "type": "float",
                             "index": "not_analyzed"},
-                        "row_sent": {
+                        "rows_sent": {
                             "type": "integer",
                             "index": "not_analyzed"},
                         "rows_examined": {
@@ -213,11 +463,7 @@ class SlowquerySender:
             return False
 
     def refreshLastTime(self, line):
-        timestamp = datetime.strptime(line[8:], "%y%m%d %H:%M:%S")
-        if self._GENERAL_CONFIG["TIMEZONE"]:
-            timestamp = timestamp.replace(tzinfo=tz.tzutc()).astimezone(
-                zoneinfo.gettz(self._GENERAL_CONFIG["TIMEZONE"]))
-        self._last_time = timestamp.isoformat()
+        self._last_time = self._timestamps.convertSlowLogTime(line[8:])
 
     def removeDuplicatedLineFeed(self, s):
         stripped = s.strip()
@@ -225,213 +471,918 @@ class SlowquerySender:
         stripped = re.sub(r"(\n)+", r"\n", stripped)
         return stripped
 
-    def appendDoc2Data(self, doc, flush=False):
-        doc["timestamp"] = self._last_time
-        doc["sql"] = self.removeDuplicatedLineFeed(doc["sql"])
-        self._data.append({"index": {
-            "_index": self._ES_INDEX,
-            "_type": self._GENERAL_CONFIG["RDS_ID"]}})
-        self._data.append(doc)
+    # It is done only once, even if the doc is held or parsed in a worker process.
+    def refineDoc(self, doc):
+        if doc.fingerprint_hash:
+            return
+        doc.sql = self.removeDuplicatedLineFeed(doc.sql)
+        doc.fingerprint, doc.fingerprint_hash = self._fingerprinter.makeFingerprint(doc.sql)
+
+    def appendDoc2Data(self, doc):
+        if doc.name is None:
+            self.holdDoc(doc)
+            return
+
+        self.refineDoc(doc)
+        if self._GENERAL_CONFIG["DIGEST_MODE"] != "raw":
+            self._aggregator.add(doc, doc.fingerprint)
+        if self._histograms is not None:
+            self._histograms.add(doc.fingerprint_hash, doc.timestamp, doc.query_time)
+        if self._GENERAL_CONFIG["DIGEST_MODE"] == "digest":
+            return
+        if self._sampler is not None and not self._sampler.add(doc):
+            return
+
+        self.appendRawDoc(doc)
+
+    def appendRawDoc(self, doc):
+        if self._sql_texts is not None:
+            self.appendSqlText(doc)
+        self._indexer.appendLines(self._ES_ACTIONS["raw"], doc.toJson())
 
         self._num_of_total_doc += 1
-        if len(self._data) > 100000 or flush:
-            print("I'll gonna send~!")
-            self._es.bulk(index=self._ES_INDEX, body=self._data, refresh=flush)
-
-    def initNewDoc(self, doc, l1, l2, i):
-        if l1.startswith("# Time: "):
-            self.refreshLastTime(l1)
-            doc["timestamp"] = self._last_time
-            i += 2  # Because we use two lines above.
-        elif l1.startswith("# User@Host: "):
-            doc["timestamp"] = self._last_time
-            l2 = l1
-            i += 1
-        else:
-            doc["timestamp"] = self._last_time
-            print("There is an another pattern!")
-
-        doc["user"] = l2.split("[")[1].split("]")[0]
-        doc["client"] = l2.split("[")[2].split("]")[0]
-        doc["client_id"] = l2.split(" Id: ")[1]
-        ip_addr = doc["client"]
-        if ip_addr not in self._ec2dict:
-            doc["name"] = "Missed"
-        else:
-            doc["name"] = self._ec2dict[ip_addr]
+
+    # The hash is the id of SQL text, so sending it again only overwrites the same document.
+    def appendSqlText(self, doc):
+        sql = self._sql_texts.shrink(doc)
+        if sql is None:
+            return
+
+        action = json.dumps({"index": {
+            "_index": self._ES_SQL_INDEX,
+            "_type": self._GENERAL_CONFIG["RDS_ID"],
+            "_id": doc.sql_hash}})
+        self._indexer.appendLines(action, json.dumps({
+            "sql_hash": doc.sql_hash,
+            "fingerprint_hash": doc.fingerprint_hash,
+            "timestamp": doc.timestamp,
+            "length": len(sql),
+            "sql": sql}))
+
+    # Samples held for the reservoir and the slowest are sent when the file is closed, and the first ones of a
+    # fingerprint are counted again from the next file.
+    def appendSamples2Data(self):
+        if self._sampler is None:
+            return
+
+        for doc in self._sampler.popSamples():
+            self.appendRawDoc(doc)
+        print("Sampled %(kept)d of %(seen)d slow queries" % self._sampler.getStats())
+        self._sampler.clear()
+
+    def appendAggregates2Data(self):
+        self.appendSamples2Data()
+        self.appendDigests2Data()
+        self.appendHistograms2Data()
+
+    def appendDigests2Data(self):
+        for digest in self._aggregator.getDigests():
+            self._indexer.appendLines(self._ES_ACTIONS["digest"], json.dumps(digest))
+        print("Written Digests : %d" % len(self._aggregator))
+        self._aggregator.clear()
+
+    def appendHistograms2Data(self):
+        if self._histograms is None:
+            return
+
+        existing = self.getHistogramDocs(self._histograms.getKeys())
+        for key, doc in self._histograms.getDocs(existing):
+            action = json.dumps({"index": {
+                "_index": self._ES_HISTOGRAM_INDEX,
+                "_type": self._GENERAL_CONFIG["RDS_ID"],
+                "_id": self.makeHistogramId(key)}})
+            self._indexer.appendLines(action, json.dumps(doc))
+        print("Written Histograms : %d, merged %d" % (len(self._histograms), len(existing)))
+        self._histograms.clear()
+
+    # A time bucket can be written by several runs or files, so it has one document per instance and fingerprint.
+    def makeHistogramId(self, key):
+        return "%s:%s:%s" % (self._GENERAL_CONFIG["RDS_ID"], key[0], key[1])
+
+    # Histograms already sent of the keys. Get by id is realtime, so the ones just sent are found without refresh.
+    def getHistogramDocs(self, keys):
+        existing = dict()
+        size = self._GENERAL_CONFIG["BULK_MAX_DOCS"]
+        for i in range(0, len(keys), size):
+            chunk = keys[i:i + size]
+            response = self._es.mget(
+                index=self._ES_HISTOGRAM_INDEX,
+                doc_type=self._GENERAL_CONFIG["RDS_ID"],
+                body={"ids": [self.makeHistogramId(key) for key in chunk]})
+            for key, doc in zip(chunk, response["docs"]):
+                if doc.get("found"):
+                    existing[key] = doc["_source"]
+        return existing
+
+    # A refresh makes documents searchable at once. Polls of daemon mode leave it to the refresh interval of the index,
+    # except when aggregates are closed.
+    def flushData(self, refresh=True):
+        self._indexer.close(refresh=refresh)
+
+        sent, failed = self._indexer.getStats()
+        print("%s : Sent %d docs, failed %d docs" % (str(datetime.now()), sent, failed))
+        print("send : %(requests)d requests, %(docs_per_sec).1f docs/s, busy %(busy).1fs, blocked %(blocked).1fs, in flight %(inflight)d/%(concurrency)d" %
+              self._indexer.getCounters())
+
+    def initNewDoc(self, line):
+        client = line.split("[")[2].split("]")[0]
+        doc = SlowQueryRecord(
+            self._last_time,
+            line.split("[")[1].split("]")[0],
+            client,
+            line.split(" Id: ")[1],
+            self.lookupEC2Name(client))
 
         self._new_doc = False
 
-        return doc, i
+        return doc
 
-    def run(self):
-        log_filename = self._SLOWQUERYLOG_PREFIX + str((self._now.utcnow()).hour)
-        log_data = self.getRdsSlowQlog(log_filename)
+    # Parse lines one by one and yield each entry as soon as the next one begins.
+    def parseSlowQlog(self, lines):
+        doc = None
 
-        if not log_data:
-            print("%s does not exist!" % (log_filename))
-            return -1
+        for line in lines:
+            if self.isNewDoc(line):
+                if doc is not None:
+                    yield doc
+                    doc = None
+
+                if line.startswith("# Time: "):
+                    self.refreshLastTime(line)
+                else:
+                    doc = self.initNewDoc(line)
+                continue
+
+            # Consider a case when only new one is appeared.
+            if doc is None:
+                continue
 
-        lines = log_data.split("\n")
-        if len(lines) > 0:
-            if not self.validateLogDate(lines):
-                print("%s already read log!" % (log_filename))
-                return -2
+            if line.startswith("# Query_time: "):
+                m = self._REGEX4REFINE["REG_TIME"].match(line).groups(0)
+                doc.query_time = float(m[0])
+                doc.lock_time = float(m[1])
+                doc.rows_sent = int(m[2])
+                doc.rows_examined = int(m[3])
+            else:
+                if doc.sql:
+                    doc.sql += "\n" + line
+                else:
+                    doc.sql = line
+                self._new_doc = True
+
+        if doc is not None:
+            yield doc
+
+    def batchDocs(self, docs, size):
+        batch = list()
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    # Resolve unknown clients and fingerprint, out of the thread which feeds the indexer.
+    def enrichDocs(self, batches):
+        for batch in batches:
+            unresolved = [doc for doc in batch if doc.name is None]
+            if unresolved:
+                self._ec2names.resolvePending()
+                for doc in unresolved:
+                    doc.name = self._ec2names.getName(doc.client)
+
+            for doc in batch:
+                self.refineDoc(doc)
+            yield batch
+
+    # Split pages into chunks which begin at an entry, together with the last time before each chunk.
+    def splitChunks(self, pages, chunk_bytes):
+        last_time = self._last_time
+        buf = list()
+        size = 0
+        for page in pages:
+            buf.append(page)
+            size += len(page)
+            if size < chunk_bytes:
+                continue
+
+            data = "".join(buf)
+            cut = self.findEntryBoundary(data)
+            if cut <= 0:
+                buf, size = [data], len(data)
+                continue
+
+            chunk = data[:cut]
+            yield chunk, last_time
+            last_time = self.findLastTime(chunk, last_time)
+            buf = [data[cut:]]
+            size = len(buf[0])
+
+        data = "".join(buf)
+        if data:
+            yield data, last_time
+
+    # Offset of the last entry, including "# Time: " line just before "# User@Host: ".
+    def findEntryBoundary(self, data):
+        cut = data.rfind("\n# User@Host: ")
+        if cut < 0:
+            return -1
+        prev = data.rfind("\n", 0, cut)
+        if data.startswith("# Time: ", prev + 1):
+            cut = prev
+        return cut + 1
+
+    def findLastTime(self, chunk, last_time):
+        pos = chunk.rfind("\n# Time: ")
+        if pos < 0:
+            if not chunk.startswith("# Time: "):
+                return last_time
         else:
-            print("%s is empty!" % (log_filename))
-            return -3
+            pos += 1
+        end = chunk.find("\n", pos)
+        line = chunk[pos:end] if end >= 0 else chunk[pos:]
+        return self._timestamps.convertSlowLogTime(line[8:])
+
+    # It runs in a worker process. Names are looked up by the parent, which has the EC2 cache.
+    def parseChunk(self, data, last_time):
+        self._last_time = last_time
+        self._new_doc = True
 
-        # Get ready for extracting log file.
-        self.initLastTime(self._LOG_CONFIG["LOG_OUTPUT_DIR"])
-        self.initEC2InstancesInVpc(
-            self._GENERAL_CONFIG["AWS_EC2_REGION_ID"],
-            self._GENERAL_CONFIG["AWS_EC2_VPC_ID"])
+        docs = list()
+        for doc in self.parseSlowQlog(splitLines([data])):
+            self.refineDoc(doc)
+            docs.append(doc)
+        return docs, self._last_time
+
+    def isParallelParsing(self, log_file):
+        return (self._GENERAL_CONFIG["PARSE_PROCESSES"] > 1 and
+                log_file["Size"] >= 2 * self._GENERAL_CONFIG["PARSE_CHUNK_BYTES"])
+
+    # Chunks are parsed in worker processes of the long-lived pool and docs are yielded in order of the log.
+    # A few chunks are in flight per process, so that the whole log never stays in memory.
+    def parseSlowQlogInParallel(self, pages):
+        processes = self._GENERAL_CONFIG["PARSE_PROCESSES"]
+        pending = collections.deque()
+        for chunk in self.splitChunks(pages, self._GENERAL_CONFIG["PARSE_CHUNK_BYTES"]):
+            pending.append(self._parse_pool.apply_async(parseSlowQlogChunk, (self._GENERAL_CONFIG, chunk)))
+            if len(pending) < 2 * processes:
+                continue
+            for doc in self.takeChunkResult(pending.popleft()):
+                yield doc
+
+        while pending:
+            for doc in self.takeChunkResult(pending.popleft()):
+                yield doc
+
+    def takeChunkResult(self, result):
+        docs, last_time = result.get()
+        for doc in docs:
+            doc.name = self.lookupEC2Name(doc.client)
+        self._last_time = last_time
+        return docs
+
+    # Parse archived raw log again, e.g. when the index is rebuilt. hour is UTC hour of the log file.
+    # Pages are the members of one file in the order they were archived.
+    def replay(self, pages, hour):
+        local_hour = self._timestamps.makeLocalTime(hour.year, hour.month, hour.day, hour.hour, 0, 0)
+        self._now = local_hour.replace(tzinfo=None)
+        self._last_time = local_hour.isoformat()
         self.setTargetIndex()
+        if self._ec2names is None:
+            self.initEC2Names()
+
+        for doc in self.parseSlowQlog(splitLines(pages)):
+            self.appendDoc2Data(doc)
+        self.releaseDocs()
+        self.appendAggregates2Data()
+        return self._num_of_total_doc
+
+    def initTemplate(self):
         self.createTemplate(self._GENERAL_CONFIG["INDEX_PREFIX"])
 
-        print("%s : Ready to write %s in %s" % (str(datetime.now()), log_filename, self._ES_INDEX))
-        i = 0
-        doc = {}
+    def saveCheckpoint(self, log_file):
+        self._checkpoint.update(
+            self._GENERAL_CONFIG["RDS_ID"], log_file["LogFileName"],
+            marker=self._marker,
+            size=log_file["Size"],
+            last_written=log_file["LastWritten"],
+            digest=self._head_digest[0],
+            head_lines=self._head_digest[1],
+            last_time=self._last_time)
+        self._checkpoint.save()
+
+    # Only once a process, and not on every poll of daemon mode.
+    def start(self):
+        if self._started:
+            return
+
+        # It has to be called before a checkpoint restores the last time.
+        self.initLastTime(self._LOG_CONFIG["LOG_OUTPUT_DIR"])
+        self.createTemplate(self._GENERAL_CONFIG["INDEX_PREFIX"])
+        # A standalone sender runs in the main thread. In fleet mode the pool is given before workers get started.
+        if self._parse_pool is None and self._GENERAL_CONFIG["PARSE_PROCESSES"] > 1:
+            self._parse_pool = makeParsePool(self._GENERAL_CONFIG["PARSE_PROCESSES"])
+        self._started = True
+
+    # The same file name is reused for the next hour a day later, so the hour is compared as well.
+    def holdFile(self, log_filename):
+        hour = self._reaminer.makeLogHour(log_filename)
+        if self._held_file is not None and (self._held_file != log_filename or self._held_hour != hour):
+            self.closeAggregates()
+        self._held_file = log_filename
+        self._held_hour = hour
+
+    # RDS may still append to the file of an hour for a while after the hour, as the cron job in README waits for.
+    def isHeldFileClosed(self):
+        if self._held_file is None:
+            return False
+        return datetime.utcnow() >= self._held_hour + timedelta(hours=1) + self._HOUR_GRACE
 
-        # Consider a case when only new one is appeared.
-        while not self.isNewDoc(lines[i]):
-            i += 1
-            continue
+    # A poll which fails in the middle of a file is retried from the last marker. So the aggregates are restored to
+    # the last file sent, and the pages of the poll are dropped, not to be counted twice.
+    def saveAggregates(self):
+        self._saved_aggregates = copy.deepcopy((self._aggregator, self._histograms, self._sampler))
 
-        while i < len(lines):
-            line = lines[i]
+    def rollbackAggregates(self):
+        self._unresolved = list()
+        self.dropRawLog()
+        if self._saved_aggregates is None:
+            return
 
-            if self.isNewDoc(line):
-                if doc:
-                    self.appendDoc2Data(doc)
-                    doc = {}
+        print("%s : Roll back aggregates of %s" % (str(datetime.now()), self._held_file))
+        self._aggregator, self._histograms, self._sampler = self._saved_aggregates
+        self._saved_aggregates = None
 
-                doc, i = self.initNewDoc(doc, lines[i], lines[i + 1], i)
-                line = lines[i]
+    def dropRawLog(self):
+        if self._raw_pages is None:
+            return
 
-            if line.startswith("# Query_time: "):
-                m = self._REGEX4REFINE["REG_TIME"].match(line).groups(0)
-                doc["query_time"] = m[0]
-                doc["lock_time"] = m[1]
-                doc["rows_sent"] = m[2]
-                doc["rows_examined"] = m[3]
-            else:
-                if doc.get("sql"):
-                    doc["sql"] += "\n" + line
-                else:
-                    doc["sql"] = line
-                self._new_doc = True
+        self._raw_pages.close()
+        self._raw_pages = None
 
-            i += 1
+    def closeAggregates(self):
+        if self._held_file is None:
+            return
 
-        if doc:
-            self.appendDoc2Data(doc, flush=True)
+        print("%s : Close aggregates of %s" % (str(datetime.now()), self._held_file))
+        self.appendAggregates2Data()
+        self._indexer.flush(refresh=True)
+        self._held_file = None
+        self._held_hour = None
 
-        print("Written Slow Queries : %s" % str(self._num_of_total_doc))
-        print("last_time : %s" % (self._last_time))
+    def run(self):
+        log_files = self.listRdsSlowQlogs()
+        if not log_files:
+            print("%s* have no file written since the last run!" % (self._SLOWQUERYLOG_PREFIX))
+            return -1
+
+        self.start()
+
+        plans = list()
+        for log_file in log_files:
+            marker, cp = self.resumeMarker(log_file)
+            if marker is None:
+                print("%s already read log!" % (log_file["LogFileName"]))
+                continue
+            plans.append((log_file, marker, cp))
+        if not plans:
+            return -2
 
+        # Get ready for extracting log file. It is shared already in fleet mode.
+        if self._ec2names is None:
+            self.initEC2Names()
+        self.setTargetIndex()
 
-class DirectoryManager:
-    def __init__(self, path="/var/log"):
-        self._raw_path = path
+        if len(plans) > 1:
+            print("%s : Catch up %d files from %s" % (str(datetime.now()), len(plans), plans[0][0]["LogFileName"]))
+        try:
+            for log_file, marker, cp, downloader, pages in self.prefetchRdsSlowQlogs(plans):
+                self.collectSlowQlog(log_file, marker, cp, downloader, pages)
+        except Exception:
+            self.rollbackAggregates()
+            raise
+        if not self._daemon:
+            self.closeAggregates()
+            self.closeRawLog()
+        self.flushData(refresh=not self._daemon)
 
-    def readInputPath(self, input_path):
-        input_files = list()
+        print("Written Slow Queries : %s" % str(self._num_of_total_doc))
+        print("last_time : %s" % (self._last_time))
 
-        if os.path.isfile(input_path):
-            input_files.append(input_path)
+    # One cycle of daemon mode, with clients, caches and connections kept warm. It returns True if anything was sent.
+    def poll(self):
+        self._daemon = True
+        self._now = datetime.now()
+        if self._ec2names is not None:
+            self._ec2names.refresh()
+        active = self.run() is None
+        if self.isHeldFileClosed():
+            self.closeAggregates()
+            self.closeRawLog()
+            self.flushData()
+        return active
+
+    # Aggregates held by polls are sent before the daemon exits.
+    def stop(self):
+        self.closeAggregates()
+        self.closeRawLog()
+        self.flushData()
+
+    def runForever(self):
+        interval = AdaptiveInterval(self._GENERAL_CONFIG["DAEMON_MIN_INTERVAL"], self._GENERAL_CONFIG["DAEMON_MAX_INTERVAL"])
+        try:
+            while True:
+                try:
+                    active = self.poll()
+                except Exception:
+                    # It keeps running, and waits longer while it fails.
+                    traceback.print_exc()
+                    active = False
+                time.sleep(interval.next(active))
+        finally:
+            self.stop()
+
+    # Send a file, and move its checkpoint and the watermark only after documents have been sent.
+    def collectSlowQlog(self, log_file, marker, cp, downloader, pages):
+        log_filename = log_file["LogFileName"]
+        self._head_digest = ("", 0)
+        if cp is not None:
+            self._head_digest = (cp["digest"], cp["head_lines"])
+            if cp.get("last_time"):
+                self._last_time = cp["last_time"]
+
+        first_page = next(pages, "")
+        if not first_page:
+            print("%s is empty!" % (log_filename))
+            return
+        if marker == "0":
+            self._head_digest = self._checkpoint.makeHeadDigest(first_page)
+
+        print("%s : Ready to write %s in %s from %s" % (str(datetime.now()), log_filename, self._ES_INDEX, marker))
+        self.holdFile(log_filename)
+        if self._daemon:
+            self.saveAggregates()
+        # Each stage runs in its own thread, and this thread feeds the indexer which sends asynchronously.
+        queue_size = self._GENERAL_CONFIG["PIPELINE_QUEUE_SIZE"]
+        stages = [PipelineStage("download", itertools.chain([first_page], pages), queue_size)]
+        if self.isParallelParsing(log_file):
+            print("Parse %s with %d processes" % (log_filename, self._GENERAL_CONFIG["PARSE_PROCESSES"]))
+            docs = self.parseSlowQlogInParallel(stages[-1])
         else:
-            for (dirpath, dirnames, filelist) in os.walk(input_path):
-                for fname in filelist:
-                    input_files.append(dirpath + "/" + fname)
-        return input_files
+            docs = self.parseSlowQlog(splitLines(stages[-1]))
+        stages.append(PipelineStage("parse", self.batchDocs(docs, self._GENERAL_CONFIG["PIPELINE_BATCH_DOCS"]), queue_size))
+        stages.append(PipelineStage("enrich", self.enrichDocs(stages[-1]), queue_size))
+        try:
+            for batch in stages[-1]:
+                for doc in batch:
+                    self.appendDoc2Data(doc)
+        finally:
+            for stage in reversed(stages):
+                stage.close()
+            if hasattr(pages, "close"):
+                pages.close()
+        self.releaseDocs()
+        self._indexer.flush()
+
+        print(downloader.getStats())
+        for stage in stages:
+            print(stage.getStats())
+        if self._sql_texts is not None:
+            print("sql texts : %(misses)d sent, %(hits)d skipped, %(size)d cached" % self._sql_texts.getStats())
+
+        self.commitRawLog()
+        self._saved_aggregates = None
+        self._marker = downloader.marker
+        self.saveCheckpoint(log_file)
+        self.saveWatermark(log_file)
+
+
+# Parsers of each worker process of parallel parsing, per instance in fleet mode. They are functions to be pickled
+# by multiprocessing.
+_CHUNK_PARSERS = dict()
+
+
+# Forking a process with threads can deadlock in the child. So the pool is made before threads get started, and by
+# forkserver where it is available.
+def makeParsePool(processes):
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("forkserver").Pool(processes)
+    return multiprocessing.Pool(processes)
+
+
+def parseSlowQlogChunk(config, chunk):
+    key = json.dumps(config, sort_keys=True)
+    if key not in _CHUNK_PARSERS:
+        _CHUNK_PARSERS[key] = SlowquerySender(config=config, parse_only=True)
+    return _CHUNK_PARSERS[key].parseChunk(*chunk)
+
+
+# A slow query parsed from the log. Numbers are parsed once, and it is serialized without a dict.
+class SlowQueryRecord(object):
+    __slots__ = ("timestamp", "user", "client", "client_id", "name",
+                 "query_time", "lock_time", "rows_sent", "rows_examined", "sql", "fingerprint", "fingerprint_hash",
+                 "sql_hash", "sample_weight")
+
+    def __init__(self, timestamp, user, client, client_id, name):
+        self.timestamp = timestamp
+        self.user = user
+        self.client = client
+        self.client_id = client_id
+        self.name = name
+        self.query_time = 0.0
+        self.lock_time = 0.0
+        self.rows_sent = 0
+        self.rows_examined = 0
+        self.sql = ""
+        self.fingerprint = ""
+        self.fingerprint_hash = ""
+        self.sql_hash = ""
+        self.sample_weight = 1.0
+
+    # It is sent back from worker processes of parallel parsing.
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    # sql_hash is written only when sql is shortened to its prefix.
+    def toJson(self):
+        encode = json.encoder.encode_basestring_ascii
+        sql_hash = ', "sql_hash": %s' % encode(self.sql_hash) if self.sql_hash else ""
+        return ('{"timestamp": %s, "user": %s, "client": %s, "client_id": %s, "name": %s, '
+                '"query_time": %r, "lock_time": %r, "rows_sent": %d, "rows_examined": %d, '
+                '"sql": %s%s, "fingerprint_hash": %s, "sample_weight": %r}') % (
+            encode(self.timestamp), encode(self.user), encode(self.client), encode(self.client_id), encode(self.name),
+            self.query_time, self.lock_time, self.rows_sent, self.rows_examined,
+            encode(self.sql), sql_hash, encode(self.fingerprint_hash), self.sample_weight)
+
+
+# Normalize a query like pt-query-digest, so that the same statement with different literals is grouped.
+class QueryFingerprinter:
+    def __init__(self):
+        self._REGEX4FINGERPRINT = [
+            # Lines written by mysqld itself, not by the client.
+            (re.compile(r"^(use \S+|set timestamp=\d+);\s*$", re.IGNORECASE | re.MULTILINE), ""),
+            (re.compile(r"'(?:[^'\\]|\\.|'')*'"), "?"),
+            (re.compile(r'"(?:[^"\\]|\\.|"")*"'), "?"),
+            (re.compile(r"/\*.*?\*/", re.DOTALL), " "),
+            (re.compile(r"(--|#)[^\n]*"), " "),
+            (re.compile(r"\b0x[0-9a-f]+\b", re.IGNORECASE), "?"),
+            (re.compile(r"(?<![\w`.])[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", re.IGNORECASE), "?"),
+            (re.compile(r"\s+"), " "),
+            (re.compile(r"\b(in|values)\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE), r"\1(?+)"),
+            (re.compile(r"(values\(\?\+\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+", re.IGNORECASE), r"\1"),
+        ]
+
+    def makeFingerprint(self, sql):
+        fingerprint = sql
+        for regex, replacement in self._REGEX4FINGERPRINT:
+            fingerprint = regex.sub(replacement, fingerprint)
+        fingerprint = fingerprint.strip().rstrip(";").strip().lower()
+
+        encoded = fingerprint if isinstance(fingerprint, bytes) else fingerprint.encode("utf-8")
+        return fingerprint, hashlib.md5(encoded).hexdigest()[:16]
+
+
+# Content address of long SQL text. Recently sent hashes are kept in LRU order, so that repeated statements of
+# ORM or batch jobs are sent only once while they stay in the cache.
+class SqlTextCache:
+    def __init__(self, prefix_length=256, max_size=100000):
+        self._prefix_length = prefix_length
+        self._max_size = max_size
+        self._hashes = collections.OrderedDict()
+
+        # Lines written by mysqld itself differ in every entry, e.g. SET timestamp.
+        self._REGEX4SERVER_LINES = re.compile(r"^(use \S+|set timestamp=\d+);\s*$\n?", re.IGNORECASE | re.MULTILINE)
+
+        self._num_of_hits = 0
+        self._num_of_misses = 0
+
+    # Shorten sql of the doc to its prefix. It returns the full text, if it is to be sent.
+    def shrink(self, doc):
+        sql = self._REGEX4SERVER_LINES.sub("", doc.sql).strip()
+        if len(sql) <= self._prefix_length:
+            return None
+
+        encoded = sql if isinstance(sql, bytes) else sql.encode("utf-8")
+        doc.sql_hash = hashlib.sha1(encoded).hexdigest()
+        doc.sql = sql[:self._prefix_length]
+
+        if self._hashes.pop(doc.sql_hash, None) is not None:
+            self._hashes[doc.sql_hash] = True
+            self._num_of_hits += 1
+            return None
+
+        self._hashes[doc.sql_hash] = True
+        if len(self._hashes) > self._max_size:
+            self._hashes.popitem(last=False)
+        self._num_of_misses += 1
+        return sql
+
+    def getStats(self):
+        return {"hits": self._num_of_hits, "misses": self._num_of_misses, "size": len(self._hashes)}
+
+    def clear(self):
+        self._hashes = collections.OrderedDict()
+
+
+# Keep count, sum, min and max of each metric per fingerprint, user and client during a run.
+class DigestAggregator:
+    def __init__(self):
+        self._METRICS = ("query_time", "lock_time", "rows_sent", "rows_examined")
+        self._digests = dict()
+
+    def add(self, doc, fingerprint):
+        key = (doc.fingerprint_hash, doc.user, doc.client)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = {
+                "fingerprint": fingerprint,
+                "fingerprint_hash": doc.fingerprint_hash,
+                "user": doc.user,
+                "client": doc.client,
+                "name": doc.name,
+                "sample": doc.sql,
+                "first_seen": doc.timestamp,
+                "count": 0,
+            }
+            for m in self._METRICS:
+                digest[m + "_sum"] = 0
+                digest[m + "_min"] = None
+                digest[m + "_max"] = None
+            self._digests[key] = digest
+
+        digest["count"] += 1
+        digest["last_seen"] = doc.timestamp
+        for m in self._METRICS:
+            v = getattr(doc, m)
+            digest[m + "_sum"] += v
+            if digest[m + "_min"] is None or v < digest[m + "_min"]:
+                digest[m + "_min"] = v
+            if digest[m + "_max"] is None or v > digest[m + "_max"]:
+                digest[m + "_max"] = v
+            # The slowest one is the most useful sample.
+            if m == "query_time" and v == digest[m + "_max"]:
+                digest["sample"] = doc.sql
+
+    def getDigests(self):
+        for digest in self._digests.values():
+            digest["timestamp"] = digest["first_seen"]
+            yield digest
+
+    def clear(self):
+        self._digests = dict()
+
+    def __len__(self):
+        return len(self._digests)
+
+
+# Bound raw slow queries per fingerprint during a burst. The first ones are sent at once, and the rest go to
+# a reservoir of uniform samples, except the slowest ones which are always kept. A sample of the reservoir
+# stands for rest / kept entries, which is its sample_weight.
+class QuerySampler:
+    def __init__(self, first, reservoir, slowest):
+        self._first = first
+        self._reservoir = reservoir
+        self._slowest = slowest
+        self._samples = dict()
+        self._sequence = itertools.count()
+
+        self._num_of_seen = 0
+        self._num_of_kept = 0
+
+    # It returns True if the doc is to be sent at once. Otherwise the doc may be sent by popSamples.
+    def add(self, doc):
+        self._num_of_seen += 1
+        sample = self._samples.get(doc.fingerprint_hash)
+        if sample is None:
+            sample = {"seen": 0, "rest": 0, "reservoir": list(), "slowest": list()}
+            self._samples[doc.fingerprint_hash] = sample
+
+        sample["seen"] += 1
+        if sample["seen"] <= self._first:
+            self._num_of_kept += 1
+            return True
 
-    def readDatePath(self, date_path):
-        date_file_list = glob.glob(date_path + "/[0-9]*/[0-9]*/[0-9]*")
-        date_path_list = filter(lambda d: os.path.isdir(d), date_file_list)
+        # The one pushed out of the slowest is one of the rest.
+        if self._slowest > 0:
+            item = (doc.query_time, next(self._sequence), doc)
+            if len(sample["slowest"]) < self._slowest:
+                heapq.heappush(sample["slowest"], item)
+                return False
+            if item[0] <= sample["slowest"][0][0]:
+                self.addRest(sample, doc)
+                return False
+            doc = heapq.heapreplace(sample["slowest"], item)[2]
+
+        self.addRest(sample, doc)
+        return False
 
-        return map(self.regularizePath, date_path_list)
+    def addRest(self, sample, doc):
+        sample["rest"] += 1
+        if len(sample["reservoir"]) < self._reservoir:
+            sample["reservoir"].append(doc)
+            return
 
-    def regularizePath(self, s):
-        return re.sub("[\\\|/]+", "/", s)
+        i = random.randrange(sample["rest"])
+        if i < self._reservoir:
+            sample["reservoir"][i] = doc
 
-    def mkdir(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
+    def popSamples(self):
+        for sample in self._samples.values():
+            for query_time, sequence, doc in sample["slowest"]:
+                doc.sample_weight = 1.0
+                self._num_of_kept += 1
+                yield doc
 
-    def rmdir(self, path):
-        # It prevents from deleting all your disk files.
-        if path == "/" or not os.path.exists(path):
-            return False
+            if sample["reservoir"]:
+                weight = float(sample["rest"]) / len(sample["reservoir"])
+                for doc in sample["reservoir"]:
+                    doc.sample_weight = weight
+                    self._num_of_kept += 1
+                    yield doc
 
-        for root, dirs, files in os.walk(path, topdown=False):
-            for name in files:
-                print('remove: ' + os.path.join(root, name))
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                print('removedir: ' + os.path.join(root, name))
-                os.removedirs(os.path.join(root, name))
-        return True
-
-    def isEmptyDir(self, dir):
-        if os.path.exists(dir) and os.listdir(dir) == []:
-            return True
-        else:
-            return False
+            sample["rest"] = 0
+            sample["reservoir"] = list()
+            sample["slowest"] = list()
 
+    def getStats(self):
+        return {"seen": self._num_of_seen, "kept": self._num_of_kept}
 
-class RawFileRemainer(DirectoryManager):
-    def __init__(self, path):
-        DirectoryManager.__init__(self, path)
-        self._due_date = timedelta(weeks=2)
+    def clear(self):
+        self._samples = dict()
 
-    def clearOutOfDateRawFiles(self):
-        target = self.readDatePath(self._raw_path)
 
-        for t in target:
-            sp = t.split("/")
-            if self.isOutOfDate(int(sp[-3]), int(sp[-2]), int(sp[-1])):
-                print("delete : " + t)
-                self.rmdirRecursively(t)
+# HDR style sketch of query_time. Bucket boundaries are fixed, so that sketches of any hour or instance are merged exactly.
+class LatencyHistogram:
+    MIN_VALUE = 0.000001
+    GROWTH = 1.02
+    QUANTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
 
-    def isOutOfDate(self, year, month, day):
-        target = date(year, month, day)
-        if (date.today() - target) > self._due_date:
-            return True
-        else:
-            return False
-
-    def rmdirRecursively(self, target_dir):
-        self.rmdir(target_dir)
-
-        if self.isEmptyDir(target_dir):
-            print("removedirs!: " + target_dir)
-            os.removedirs(target_dir)
-        month_dir = target_dir[:-3]
-        if self.isEmptyDir(month_dir):
-            print("isEmptyDir!: " + month_dir)
-            os.removedirs(month_dir)
-        year_dir = target_dir[:-6]
-        if self.isEmptyDir(year_dir):
-            print("isEmptyDir!: " + year_dir)
-            os.removedirs(year_dir)
-
-    def makeRawLog(self, name, raw_data):
-        cur_date_path = self._raw_path + self._now.strftime("/%Y/%m/%d/")
-        raw_name = datetime.now().strftime("%Hh%Mm%Ss_") + name
-
-        if not os.path.exists(cur_date_path):
-            self.mkdir(cur_date_path)
-        raw_path = cur_date_path + raw_name
-        f = open(raw_path, "w")
-        f.write(raw_data)
-        f.close()
-        print("%s : Remain raw log data : %s" % (str(datetime.now()), raw_path))
+    def __init__(self):
+        self._counts = dict()
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    # Relative error of a quantile is within half of GROWTH, and there are about 1300 buckets up to a day.
+    def getIndex(self, value):
+        if value <= self.MIN_VALUE:
+            return 0
+        return int(math.log(value / self.MIN_VALUE) / math.log(self.GROWTH)) + 1
+
+    def getValue(self, index):
+        if index == 0:
+            return self.MIN_VALUE
+        lower = self.MIN_VALUE * (self.GROWTH ** (index - 1))
+        return lower * math.sqrt(self.GROWTH)
+
+    def add(self, value, count=1):
+        index = self.getIndex(value)
+        self._counts[index] = self._counts.get(index, 0) + count
+        self._count += count
+        self._sum += value * count
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def merge(self, other):
+        for index, count in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self._count += other._count
+        self._sum += other._sum
+        if other._min is not None and (self._min is None or other._min < self._min):
+            self._min = other._min
+        if other._max is not None and (self._max is None or other._max > self._max):
+            self._max = other._max
+
+    def getQuantile(self, q):
+        if self._count == 0:
+            return None
+
+        rank = q * self._count
+        seen = 0
+        for index in sorted(self._counts.keys()):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(max(self.getValue(index), self._min), self._max)
+        return self._max
+
+    def toDoc(self):
+        indexes = sorted(self._counts.keys())
+        doc = {
+            "count": self._count,
+            "sum": self._sum,
+            "min": self._min,
+            "max": self._max,
+            # Parallel arrays rather than an object, so that the mapping does not grow with buckets.
+            "bucket_index": indexes,
+            "bucket_count": [self._counts[i] for i in indexes],
+        }
+        for name, q in self.QUANTILES:
+            doc[name] = self.getQuantile(q)
+        return doc
+
+    @classmethod
+    def fromDoc(cls, doc):
+        histogram = cls()
+        histogram._counts = dict(zip(doc["bucket_index"], doc["bucket_count"]))
+        histogram._count = doc["count"]
+        histogram._sum = doc["sum"]
+        histogram._min = doc["min"]
+        histogram._max = doc["max"]
+        return histogram
+
+
+# Histograms per fingerprint and time bucket. Beyond max_sketches, the rest is merged into one of each time bucket.
+class HistogramAggregator:
+    def __init__(self, interval_minutes=60, max_sketches=10000):
+        self._OVERFLOW = "others"
+
+        if interval_minutes <= 0:
+            raise ValueError("HISTOGRAM_INTERVAL_MINUTES must be positive : %s" % interval_minutes)
+
+        self._interval = interval_minutes
+        self._max_sketches = max_sketches
+        self._histograms = dict()
+        self._buckets = dict()
+
+    # Truncate ISO 8601 timestamp to the interval in epoch seconds, and keep its timezone offset.
+    # Every second of a minute falls in the same bucket, so that it is cached per minute.
+    def getTimeBucket(self, timestamp):
+        key = timestamp[:16] + timestamp[19:]
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= 4096:
+                self._buckets.clear()
+            bucket = self.makeTimeBucket(timestamp)
+            self._buckets[key] = bucket
+        return bucket
+
+    def makeTimeBucket(self, timestamp):
+        offset = self.parseOffset(timestamp[19:])
+        local = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+        seconds = calendar.timegm(local.timetuple()) - offset
+        seconds -= seconds % (self._interval * 60)
+        return datetime.utcfromtimestamp(seconds + offset).strftime("%Y-%m-%dT%H:%M:%S") + timestamp[19:]
+
+    # "+09:00", "-05:30" or "" of a naive timestamp, in seconds.
+    def parseOffset(self, s):
+        if not s or s == "Z":
+            return 0
+        seconds = int(s[1:3]) * 3600 + int(s[4:6]) * 60
+        return -seconds if s[0] == "-" else seconds
+
+    def add(self, fingerprint_hash, timestamp, query_time):
+        key = (fingerprint_hash, self.getTimeBucket(timestamp))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            if len(self._histograms) >= self._max_sketches:
+                key = (self._OVERFLOW, key[1])
+                histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self._histograms[key] = histogram
+        histogram.add(query_time)
+
+    def getKeys(self):
+        return list(self._histograms.keys())
+
+    # existing is the docs already sent per key, which are merged into the ones to be sent.
+    def getDocs(self, existing=None):
+        for key, histogram in self._histograms.items():
+            if existing and key in existing:
+                merged = LatencyHistogram.fromDoc(existing[key])
+                merged.merge(histogram)
+                histogram = merged
+            doc = histogram.toDoc()
+            doc["fingerprint_hash"] = key[0]
+            doc["timestamp"] = key[1]
+            doc["interval_minutes"] = self._interval
+            yield key, doc
+
+    def clear(self):
+        self._histograms = dict()
+
+    def __len__(self):
+        return len(self._histograms)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", dest="daemon", help="keep polling instead of a run", action="store_true")
+    args = parser.parse_args()
+
     sq2es = SlowquerySender()
-    try:
-        sq2es.run()
-    except Exception as e:
-        print(e)
\ No newline at end of file
+    if args.daemon:
+        sq2es.runForever()
+    else:
+        try:
+            sq2es.run()
+        except Exception as e:
+            print(e)
\ No newline at end of file